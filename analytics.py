@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+from columnar import ColumnarLedger
+from money import to_units, from_units
+from storage import date_ordinal
+import datetime
+import threading
+
+# NumPy is optional: without it the same figures come from plain Python loops
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+PERIODS = ('month', 'quarter', 'year')
+
+
+# The ledger turned into parallel columns for whole-ledger arithmetic:
+#   accounts -> code into self.numbers ('1010', '4010', ...)
+#   ordinals -> date ordinal, -1 if the date can't be read
+#   debits, credits -> whole cents
+# With NumPy the columns are int64 arrays, otherwise lists of ints.
+# update() only converts the rows added since the last call. It may be called from any
+# thread (the page worker, autosave, the server's saves): calls take turns, and the
+# columns are only ever replaced by longer ones, so rows a caller has updated stay readable.
+class LedgerArrays:
+
+    def __init__(self, ledger=()):
+        self.numbers = []  # code -> account number
+        self.codes = {}  # account number -> code
+        self.rows = 0
+        self.lock = threading.Lock()
+        if np is not None:
+            self.accounts = np.empty(0, dtype=np.int64)
+            self.ordinals = np.empty(0, dtype=np.int64)
+            self.debits = np.empty(0, dtype=np.int64)
+            self.credits = np.empty(0, dtype=np.int64)
+        else:
+            self.accounts = []
+            self.ordinals = []
+            self.debits = []
+            self.credits = []
+        self.update(ledger)
+
+    def __len__(self):
+        return self.rows
+
+    # convert the rows of the ledger past self.rows
+    def update(self, ledger):
+        with self.lock:
+            if np is not None and isinstance(ledger, ColumnarLedger):
+                self.update_columns(ledger)
+            else:
+                self.update_rows(ledger)
+
+    def update_rows(self, ledger):
+        rows = ledger[self.rows:]
+        if not rows:
+            return
+        accounts = []
+        ordinals = []
+        debits = []
+        credits = []
+        for row in rows:
+            accounts.append(self.code(row[2].split(' ', 1)[0]))
+            ordinal = date_ordinal(row[1])
+            ordinals.append(-1 if ordinal is None else ordinal)
+            debits.append(to_units(row[4]))
+            credits.append(to_units(row[5]))
+        if np is not None:
+            self.accounts = np.concatenate((self.accounts, np.array(accounts, dtype=np.int64)))
+            self.ordinals = np.concatenate((self.ordinals, np.array(ordinals, dtype=np.int64)))
+            self.debits = np.concatenate((self.debits, np.array(debits, dtype=np.int64)))
+            self.credits = np.concatenate((self.credits, np.array(credits, dtype=np.int64)))
+        else:
+            self.accounts.extend(accounts)
+            self.ordinals.extend(ordinals)
+            self.debits.extend(debits)
+            self.credits.extend(credits)
+        self.rows += len(rows)
+
+    # a ColumnarLedger already holds cents and ordinals, so only the account ids need mapping
+    def update_columns(self, ledger):
+        start = self.rows
+        # payees is the last column ColumnarLedger.append writes, so every column has this many
+        end = len(ledger.payees)
+        if start >= end:
+            return
+        read_only = getattr(ledger, 'read_only', False)
+        if read_only:
+            # a mapped ledger never grows, so its columns are used where they are
+            columns = ledger.accounts, ledger.dates, ledger.debit, ledger.credit
+        else:
+            # copies of the new rows: a view would keep the column's buffer exported,
+            # and the posting thread could no longer append to it
+            columns = ledger.accounts[start:end], ledger.dates[start:end], ledger.debit[start:end], ledger.credit[start:end]
+        ids, dates, debit, credit = [np.frombuffer(column, dtype='i{}'.format(column.itemsize)) for column in columns]
+        unique, inverse = np.unique(ids, return_inverse=True)
+        codes = np.array([self.code(ledger.strings.get(i).split(' ', 1)[0]) for i in unique.tolist()], dtype=np.int64)
+        if read_only:
+            self.accounts = codes[inverse]
+            self.ordinals = dates
+            self.debits = debit
+            self.credits = credit
+        else:
+            self.accounts = np.concatenate((self.accounts, codes[inverse]))
+            self.ordinals = np.concatenate((self.ordinals, dates))
+            self.debits = np.concatenate((self.debits, debit))
+            self.credits = np.concatenate((self.credits, credit))
+        self.rows = end
+
+    def code(self, number):
+        try:
+            return self.codes[number]
+        except KeyError:
+            self.codes[number] = len(self.numbers)
+            self.numbers.append(number)
+            return self.codes[number]
+
+
+# {account number: debits minus credits} for the whole ledger
+def account_balances(arrays):
+    if np is not None:
+        totals = np.zeros(len(arrays.numbers), dtype=np.int64)
+        np.add.at(totals, arrays.accounts, arrays.debits - arrays.credits)
+        totals = totals.tolist()
+    else:
+        totals = [0] * len(arrays.numbers)
+        for account, debit, credit in zip(arrays.accounts, arrays.debits, arrays.credits):
+            totals[account] += debit - credit
+    return {number: from_units(totals[code]) for code, number in enumerate(arrays.numbers)}
+
+
+# One account's balance after each of its rows, in ledger order, or only over the rows at
+# 'positions' when the caller already knows where they are (e.g. from the account index).
+# sign is 1 for debit-normal accounts (assets, expenses) and -1 for the rest
+def running_balances(arrays, number, sign=1, positions=None):
+    code = arrays.codes.get(number)
+    if code is None and positions is None:
+        return []
+    if np is not None:
+        if positions is None:
+            mine = arrays.accounts == code
+        else:
+            mine = np.asarray(positions, dtype=np.int64)
+        running = np.cumsum((arrays.debits[mine] - arrays.credits[mine]) * sign).tolist()
+    else:
+        if positions is None:
+            positions = [position for position, account in enumerate(arrays.accounts) if account == code]
+        running = []
+        balance = 0
+        for position in positions:
+            balance += (arrays.debits[position] - arrays.credits[position]) * sign
+            running.append(balance)
+    return [from_units(cents) for cents in running]
+
+
+# debits minus credits, in cents, of the rows at the given ledger positions
+def fund_cents(arrays, positions):
+    if np is not None:
+        positions = np.asarray(positions, dtype=np.int64)
+        return (arrays.debits[positions] - arrays.credits[positions]).tolist()
+    return [arrays.debits[position] - arrays.credits[position] for position in positions]
+
+
+# Debit and credit totals per account and period, where period is 'month', 'quarter' or 'year':
+#   {(account number, '2019-03' | '2019-Q1' | '2019'): (debits, credits)}
+# Rows dated after 'end' or without a readable date are left out.
+def period_totals(arrays, period='month', end=None):
+    if period not in PERIODS:
+        raise ValueError('period must be one of {}'.format(', '.join(PERIODS)))
+    last = date_ordinal(end) if end is not None else None
+    if np is not None:
+        keep = arrays.ordinals >= 0
+        if last is not None:
+            keep &= arrays.ordinals <= last
+        months = (arrays.ordinals[keep] - EPOCH).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        if period == 'month':
+            buckets = months
+        elif period == 'quarter':
+            buckets = months // 3
+        else:
+            buckets = months // 12
+        # one key per (account, period) pair, then sum each key's rows
+        span = int(buckets.max() - buckets.min() + 1) if len(buckets) else 1
+        first = int(buckets.min()) if len(buckets) else 0
+        keys = arrays.accounts[keep] * span + (buckets - first)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        debits = np.zeros(len(unique), dtype=np.int64)
+        credits = np.zeros(len(unique), dtype=np.int64)
+        np.add.at(debits, inverse, arrays.debits[keep])
+        np.add.at(credits, inverse, arrays.credits[keep])
+        totals = {}
+        for key, debit, credit in zip(unique.tolist(), debits.tolist(), credits.tolist()):
+            account, bucket = divmod(key, span)
+            totals[(arrays.numbers[account], period_label(period, bucket + first))] = (debit, credit)
+    else:
+        totals = {}
+        for account, ordinal, debit, credit in zip(arrays.accounts, arrays.ordinals, arrays.debits, arrays.credits):
+            if ordinal < 0 or (last is not None and ordinal > last):
+                continue
+            day = datetime.date.fromordinal(ordinal)
+            months = (day.year - 1970) * 12 + day.month - 1
+            if period == 'month':
+                bucket = months
+            elif period == 'quarter':
+                bucket = months // 3
+            else:
+                bucket = months // 12
+            key = (arrays.numbers[account], period_label(period, bucket))
+            debits, credits = totals.get(key, (0, 0))
+            totals[key] = (debits + debit, credits + credit)
+    return {key: (from_units(debit), from_units(credit)) for key, (debit, credit) in totals.items()}
+
+
+# bucket number (months, quarters or years since 1970) -> '2019-03', '2019-Q1' or '2019'
+def period_label(period, bucket):
+    if period == 'month':
+        return '{:04d}-{:02d}'.format(1970 + bucket // 12, bucket % 12 + 1)
+    elif period == 'quarter':
+        return '{:04d}-Q{}'.format(1970 + bucket // 4, bucket % 4 + 1)
+    else:
+        return '{:04d}'.format(1970 + bucket)
+
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Saves the ledger in the background while the program is in use, so entries don't wait
+# for someone to press Save. The program is checked every CHECK_EVERY ms on the thread that
+# posts (the Tk main loop in the window); once INTERVAL seconds have passed with something
+# unsaved, or POSTINGS rows are waiting, what needs saving is copied there and written on a
+# worker thread. Only rows posted since the last save are written, and settings only if
+# they changed.
+
+import logging
+import threading
+import time
+
+# Logging Set Up
+logger = logging.getLogger(__name__)
+
+INTERVAL = 60  # seconds between autosaves while there is something to save
+POSTINGS = 20  # ledger rows that bring the next autosave forward
+CHECK_EVERY = 2000  # ms between checks
+
+
+class Autosaver:
+
+    # schedule(ms, callback) calls back on the posting thread, e.g. a Tk widget's after.
+    # saved(time.time() of the save) is called there too after each autosave,
+    # and failed(error) after one that didn't save.
+    def __init__(self, program, schedule, interval=INTERVAL, postings=POSTINGS, check_every=CHECK_EVERY,
+                 saved=None, failed=None):
+        self.program = program
+        self.schedule = schedule
+        self.interval = interval
+        self.postings = postings
+        self.check_every = check_every
+        self.saved = saved
+        self.failed = failed
+        self.writer = None  # the worker thread of the autosave in progress
+        self.result = None  # what the last worker returned, or the error it raised
+        self.last = time.monotonic()
+        self.behind = False  # another program saved, so the next save has to rebase here
+        self.stopped = False
+
+    def start(self):
+        self.schedule(self.check_every, self.tick)
+
+    def tick(self):
+        if self.stopped:
+            return
+        try:
+            self.check()
+        finally:
+            self.schedule(self.check_every, self.tick)
+
+    def check(self):
+        program = self.program
+        if self.writer is not None:
+            if self.writer.is_alive():
+                return
+            self.finish()
+        if not program.ledger_ready.is_set() or program.load_error is not None:
+            return
+        if program.unsaved_rows() < self.postings and time.monotonic() - self.last < self.interval:
+            return
+        self.last = time.monotonic()
+        if self.behind:
+            self.behind = False
+            try:
+                program.save_to_file(program.ledger, program.settings)
+            except Exception as error:
+                logger.exception("Autosave failed.")
+                if self.failed is not None:
+                    self.failed(error)
+                return
+            if self.saved is not None:
+                self.saved(time.time())
+            return
+        snapshot = program.autosave_snapshot()
+        if snapshot is None:
+            return
+        self.writer = threading.Thread(target=self.write, args=(snapshot,), daemon=True)
+        self.writer.start()
+
+    # runs on the worker thread; whatever goes wrong is reported by finish()
+    def write(self, snapshot):
+        try:
+            self.result = self.program.write_snapshot(snapshot)
+        except Exception as error:
+            logger.exception("Autosave failed.")
+            self.result = error
+
+    # back on the posting thread once the worker is done
+    def finish(self):
+        self.writer = None
+        if isinstance(self.result, Exception):
+            if self.failed is not None:
+                self.failed(self.result)
+        elif self.result is False:
+            logger.info("Another program saved the ledger; the next autosave will add its rows first.")
+            self.behind = True
+        elif self.saved is not None:
+            self.saved(time.time())
+
+    # stops checking and waits for an autosave in progress, e.g. before the program closes
+    def stop(self):
+        self.stopped = True
+        if self.writer is not None:
+            self.writer.join()
+            self.finish()
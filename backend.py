@@ -1,13 +1,26 @@
 #!/usr/bin/env python
 
-from mbox import mbox
+from errors import LedgerError, AccountError, DateError, TransactionError, InsufficientFundsError, ConflictError, \
+    ReadOnlyError
+from storage import open_store, SQLiteStore, read_summary, write_summary, read_settings, commit_generation, settings_data, \
+    checksum, date_ordinal, FileLock, TransactionAllocator, committed_settings, to_text
+from columnar import ColumnarLedger
+from binformat import MappedLedger, ARCHIVE_LEDGER, ARCHIVE_SETTINGS
+from search import SearchIndex
+from analytics import LedgerArrays, account_balances, period_totals, fund_cents, running_balances
+from periods import DateIndex, PeriodCloses, as_of_ordinal, closed_month_end
+from money import to_units, from_units, exponent, EXPONENT
+import bisect
+import itertools
 import decimal
 import simplejson as json
 import datetime
 import platform
 import logging
 import gettext
+import os
 import sys
+import threading
 
 # Logging Set Up
 logger = logging.getLogger(__name__)
@@ -23,14 +36,8 @@ sys.excepthook = lambda exc, val, tb: exception_hook(logger, exc, val, tb)
 
 
 def upload_settings():
-    try:
-        with open('resources/settings.json', 'r') as doc:
-            configs = json.load(doc)
-        return configs
-    except FileNotFoundError:
-        with open('resources/settings_template.json', 'r') as doc:
-            configs = json.load(doc)
-        return configs
+    # the settings of the last complete save (see storage.commit_generation)
+    return read_settings(template='resources/settings_template.json')
 
 
 def get_language():
@@ -51,6 +58,8 @@ if platform.system() == 'Darwin':  # if you're on a mac
 elif platform.system() == 'Windows':  # if you're on a windows
     logger.info("You're on a Windows PC.")
     SIZE = 12
+else:  # Linux, and the server and batch import with no windows at all
+    SIZE = 12
 
 D = decimal.Decimal
 get_language()
@@ -58,13 +67,9 @@ get_language()
 
 def upload_ledger(directory=None):
     if directory is None:
-        try:
-            with open('resources/matrices.txt', 'r+', encoding='utf-8') as doc:
-                ledg = json.load(doc)
-                return ledg
-        except FileNotFoundError:
-            ledg = []
-            return ledg
+        # whichever store the 'storage' setting picks (see storage.py)
+        ledg = store.load()
+        return ledg
     else:
         with open(directory, "r+", encoding='utf-8') as doc:
             ledg = json.load(doc)
@@ -72,33 +77,220 @@ def upload_ledger(directory=None):
 
 
 settings = upload_settings()
-ledger = upload_ledger()
+store = open_store(settings.get('storage', 'journal'), settings.get('snapshot_format', 'json'))
 
 
 class BaseProgram:
 
     version = "0.0.5.2"  # SOFTWARE VERSION
 
-    def __init__(self):
+    # archive is a folder made by 'binformat.py archive' to open read-only instead of the ledger
+    def __init__(self, archive=None):
         self.logger = logging.getLogger(__name__)
 
         self.version = BaseProgram.version
 
-        self.settings = settings
-        self.ledger = ledger  # [transaction, date, account, base, debit, credit, memo, payee]
+        self.read_only = archive is not None
+        if archive is None:
+            self.settings = settings
+        else:
+            self.settings = read_settings(os.path.join(archive, ARCHIVE_SETTINGS))
+        # checksum of the settings as last saved, to tell whether they need saving again
+        self.settings_sum = checksum(settings_data(self.settings))
+        # the settings on disk as this program last read or wrote them, and the manifest's
+        # checksum of them then, to tell when another program has saved its own since
+        self.settings_base = json.loads(settings_data(self.settings).decode('utf-8'))
+        self.settings_disk = committed_settings() if archive is None else None
+        self.store = None if archive is not None else store
+        self.ledger = []  # [transaction, date, account, base, debit, credit, memo, payee]
         self.SIZE = SIZE
 
         self.fundnames = self.get_fundnames()
-        # [transaction, date, account, base, debit, credit, memo, payee]
-        if len(self.ledger) > 1:
-            self.transaction = self.ledger[len(self.ledger)-1][0] + 1
+        self.cents = decimal.Decimal('.01')
+        # {account number: [ledger row positions]}
+        self.account_index = {}
+        # {account number: debits minus credits}
+        self.balances = {}
+        # {transaction number: [first row position, last row position + 1]}
+        self.transaction_index = {}
+        # words of memos, payees, accounts and amounts -> transaction numbers
+        self.search_index = SearchIndex()
+        # the ledger as cents/ordinal columns for balances and period reports
+        self.arrays = LedgerArrays()
+        # bumped whenever the ledger changes, so cached report data knows when it is stale
+        self.ledger_version = 0
+        # {(start, end): (ledger_version, period_activity result)}
+        self.activity_cache = {}
+        # ledger positions in date order, and month-end balances for 'as of' questions
+        self.date_index = DateIndex()
+        self.period_closes = PeriodCloses()
+        self.transaction = 1
+        # saves take this lock, and transaction numbers come from a counter shared by every
+        # program using these files, so several copies can work on one ledger
+        self.lock = FileLock()
+        self.allocator = TransactionAllocator()
+        # set once self.ledger holds the whole history, or load_error once reading it failed
+        self.ledger_ready = threading.Event()
+        self.load_error = None
+
+        # open from the saved summary and read the full ledger in the background,
+        # or read it now if there is no summary yet
+        summary = read_summary() if archive is None else None
+        if archive is not None:
+            self.recent = []
+            self.install_ledger(MappedLedger(os.path.join(archive, ARCHIVE_LEDGER)))
+            self.ledger_ready.set()
+        elif summary is not None:
+            self.recent = summary['recent']
+            self.balances = {number: D(amount) for number, amount in summary['balances'].items()}
+            self.transaction = summary['transaction']
+            threading.Thread(target=self.load_history, daemon=True).start()
         else:
-            self.transaction = 1
+            self.recent = []
+            self.load_history()
+            self.wait_for_ledger()
         self.payee_names = self.settings['payee_names']
 
-        self.cents = decimal.Decimal('.01')
         print('backend load successful')
 
+    # Reads the whole ledger from the store and indexes it. A failure is kept in load_error
+    # for wait_for_ledger to raise, so nothing waits for a ledger that is never coming.
+    def load_history(self):
+        try:
+            ledger = upload_ledger()
+            # a binary snapshot loads as a ColumnarLedger already
+            if self.settings.get('ledger_format') == 'columnar':
+                if not isinstance(ledger, ColumnarLedger):
+                    ledger = ColumnarLedger(ledger)
+            elif isinstance(ledger, ColumnarLedger):
+                ledger = list(ledger)
+            self.install_ledger(ledger)
+        except Exception as error:
+            self.logger.exception("The ledger could not be loaded.")
+            self.load_error = error
+        else:
+            self.logger.info("Ledger loaded (%s rows).", len(ledger))
+        self.ledger_ready.set()
+
+    # makes ledger the program's ledger, with every index rebuilt for it
+    def install_ledger(self, ledger):
+        read_only = getattr(ledger, 'read_only', False)
+        if read_only:
+            # a mapped archive never changes: its rows are found from its own columns,
+            # and the search index waits for the first search
+            account_index, transaction_index = ledger.account_positions(), None
+        else:
+            account_index, transaction_index = self.index_ledger(ledger)
+        # balances are summed in whole cents, vectorized when NumPy is installed
+        arrays = LedgerArrays(ledger)
+        balances = account_balances(arrays)
+        if read_only:
+            date_index = DateIndex.frozen(arrays.ordinals)
+            period_closes = PeriodCloses(path=None)
+            search_index = None
+        else:
+            date_index = DateIndex(arrays.ordinals)
+            period_closes = PeriodCloses()
+            period_closes.load(arrays)
+            search_index = SearchIndex(ledger)
+        self.ledger = ledger
+        self.arrays = arrays
+        self.ledger_version += 1
+        self.date_index = date_index
+        self.period_closes = period_closes
+        self.account_index = account_index
+        self.balances = balances
+        self.transaction_index = transaction_index
+        self.search_index = search_index
+        # [transaction, date, account, base, debit, credit, memo, payee]
+        if len(self.ledger) > 1:
+            self.transaction = max(self.transaction, self.ledger[len(self.ledger)-1][0] + 1)
+
+    # blocks until load_history has finished, and raises what stopped it if it failed
+    def wait_for_ledger(self):
+        self.ledger_ready.wait()
+        if self.load_error is not None:
+            raise self.load_error
+
+    # the whole ledger, or just the latest rows while the rest is still loading
+    def general_ledger(self):
+        if self.ledger_ready.is_set() and self.load_error is None:
+            return self.ledger
+        else:
+            return self.recent
+
+    # builds the account index so a fund only has to look at its own rows,
+    # and the transaction index so one transaction's rows can be found without a scan
+    def index_ledger(self, ledger):
+        account_index = {}
+        transaction_index = {}
+        for position, row in enumerate(ledger):
+            account_index.setdefault(account_number(row[2]), []).append(position)
+            index_transaction(transaction_index, row[0], position)
+        return account_index, transaction_index
+
+    # debit and credit totals per period ('month', 'quarter' or 'year') up to an optional
+    # 'DD/MM/YYYY' end date: [[period, debits, credits], ...] for one fund, or
+    # {fund number: [[period, debits, credits], ...]} for every fund
+    def period_report(self, period='month', number=None, end=None):
+        self.wait_for_ledger()
+        self.arrays.update(self.ledger)
+        report = {}
+        for (fund, label), (debits, credits) in sorted(period_totals(self.arrays, period, end).items()):
+            report.setdefault(fund, []).append([label, debits, credits])
+        if number is not None:
+            return report.get(number, [])
+        return report
+
+    # While the history is still loading, an SQLite store answers lookups from its indexes
+    # (see SQLiteStore.fund_rows); None once the ledger is in memory, or for the other stores.
+    def indexed_store(self):
+        if self.ledger_ready.is_set() or not isinstance(self.store, SQLiteStore):
+            return None
+        return self.store
+
+    # the ledger rows of one transaction
+    def transaction_rows(self, trans):
+        store = self.indexed_store()
+        if store is not None:
+            return store.transaction_rows(trans)
+        self.wait_for_ledger()
+        if self.transaction_index is None:
+            return [self.ledger[position] for position in self.ledger.positions_of(trans)]
+        try:
+            first, end = self.transaction_index[trans]
+        except KeyError:
+            return []
+        # a transaction's rows are written together, the check is only for safety
+        return [row for row in self.ledger[first:end] if row[0] == trans]
+
+    # the ledger rows dated from start to end ('DD/MM/YYYY', both included), in date order
+    def rows_between(self, start, end):
+        validate_date(start)
+        validate_date(end)
+        store = self.indexed_store()
+        if store is not None:
+            return store.rows_between(start, end)
+        self.wait_for_ledger()
+        positions = self.date_index.positions_between(date_ordinal(start) - 1, date_ordinal(end))
+        return [self.ledger[int(position)] for position in positions]
+
+    # True if anything has been posted to the fund
+    def has_postings(self, number, balances=None):
+        if balances is None:
+            balances = self.balances
+        return number in balances
+
+    # closing balance of a fund, with the sign load_fund would give it
+    def fund_balance(self, number, balances=None):
+        if balances is None:
+            balances = self.balances
+        balance = balances.get(number, D('0.00'))
+        if number in self.settings['accounts']['assets'] or number in self.settings['accounts']['expenses']:
+            return balance
+        else:
+            return D('0.00') - balance
+
     def get_funds(self):
         funds = []
         for category in self.settings['accounts']:
@@ -133,9 +325,151 @@ class BaseProgram:
         name = '{} {}'.format(number, self.settings['accounts']['expenses'][number][0])
         return name
 
-    def save(self):
-        with open('resources/matrices.txt', 'w+', encoding='utf8') as doc:
-            json.dump(self.ledger, doc, ensure_ascii=False)
+    # transaction numbers of the rows matching a search (see SearchIndex.search)
+    def search_ledger(self, pattern):
+        if self.search_index is None:
+            self.search_index = SearchIndex(self.ledger)
+        return self.search_index.search(pattern)
+
+    def check_writable(self):
+        if self.read_only:
+            raise ReadOnlyError(_('This ledger is open read-only.'))
+
+    # appends the new ledger rows to the journal, saving settings with them if given
+    def save(self, settings=None):
+        self.check_writable()
+        self.wait_for_ledger()
+        with self.lock:
+            if self.store.changed():
+                self.rebase()
+            self.rebase_settings()
+            data = None if settings is None else settings_data(settings)
+            self.store.append(self.ledger, data)
+            if data is not None:
+                self.settings_saved(data)
+            write_summary(self.ledger, self.transaction, self.balances)
+            self.save_period_closes()
+
+    # ledger rows posted since the last save
+    def unsaved_rows(self):
+        return len(self.ledger) - self.store.saved
+
+    # Everything a save needs, copied on the thread that posts so write_snapshot can run on
+    # another while posting carries on. None if there is nothing to save.
+    def autosave_snapshot(self):
+        # nothing is saved over a ledger that never loaded
+        if self.read_only or not self.ledger_ready.is_set() or self.load_error is not None:
+            return None
+        self.settings['payee_names'] = self.payee_names
+        data = settings_data(self.settings)
+        if checksum(data) == self.settings_sum:
+            data = None
+        rows = len(self.ledger)
+        if data is None and rows == self.store.saved:
+            return None
+        return {'rows': rows, 'settings': data, 'base': self.settings_sum, 'transaction': self.transaction,
+                'balances': dict(self.balances), 'closes': dict(self.period_closes.closes)}
+
+    # Saves a snapshot from autosave_snapshot: only the rows past the last save, and the
+    # settings only if they changed. Returns False without saving if another program has
+    # saved since, as putting its rows in has to happen on the thread that posts (see rebase).
+    def write_snapshot(self, snapshot):
+        with self.lock:
+            if self.store.changed():
+                return False
+            if self.store.saved > snapshot['rows']:  # a save from the posting thread got further
+                return True
+            settings = snapshot['settings']
+            if self.settings_sum != snapshot['base']:  # saved since the copy was taken
+                settings = None
+            if settings is not None and committed_settings() != self.settings_disk:
+                return False  # another program's settings have to be merged in first
+            self.store.append(self.ledger, settings, snapshot['rows'])
+            if settings is not None:
+                self.settings_saved(settings)
+            write_summary(self.ledger, snapshot['transaction'], snapshot['balances'], rows=snapshot['rows'])
+            self.period_closes.save(snapshot['rows'], snapshot['closes'])
+        return True
+
+    # Another program saved since this one last read or wrote the ledger: read what is on
+    # disk now and put this program's unsaved rows after it. Raises ConflictError, leaving
+    # everything as it was, if the rows this program had already saved are no longer there.
+    def rebase(self):
+        store = self.store.reopen()
+        theirs = store.load()
+        saved = self.store.saved
+        if saved and (len(theirs) < saved or theirs[saved - 1][:3] != list(self.ledger[saved - 1][:3])):
+            self.logger.error("The ledger on disk no longer starts with the rows saved from here.")
+            raise ConflictError(_('The ledger was replaced by another copy of CFAP. '
+                                  'Nothing was saved; please reopen the program.'))
+        mine = [list(row) for row in self.ledger[saved:]]
+        # only a program without the shared counter can have used the same numbers
+        taken = {row[0] for row in theirs[saved:]}
+        renumbered = {}
+        for row in mine:
+            if row[0] in taken:
+                if row[0] not in renumbered:
+                    renumbered[row[0]] = self.allocator.allocate(max(self.transaction, max(taken) + 1))
+                row[0] = renumbered[row[0]]
+        if renumbered:
+            self.logger.warning("Renumbered transactions %s that another program had also used.", renumbered)
+        if isinstance(self.ledger, ColumnarLedger):
+            ledger = theirs if isinstance(theirs, ColumnarLedger) else ColumnarLedger(theirs)
+            ledger.extend(mine)
+        else:
+            ledger = list(theirs) + mine
+        self.store = store
+        self.install_ledger(ledger)
+        self.logger.info("Added %s rows saved by another program.", len(theirs) - saved)
+
+    # Another program saved its settings since this one last read or wrote them: fold its
+    # changes into these (see merge_settings), so writing them doesn't lose its exchange-rate
+    # records, payees or funds. Hold self.lock.
+    def rebase_settings(self):
+        if committed_settings() == self.settings_disk:
+            return
+        theirs = read_settings()
+        self.settings['payee_names'] = self.payee_names
+        merge_settings(self.settings_base, self.settings, theirs)
+        self.payee_names = self.settings['payee_names']
+        self.settings_base = theirs
+        self.settings_disk = committed_settings()
+        self.logger.info("Merged the settings saved by another program.")
+
+    # settings data has just been committed
+    def settings_saved(self, data):
+        self.settings_sum = self.settings_disk = checksum(data)
+        self.settings_base = json.loads(data.decode('utf-8'))
+
+    # takes the next number from the shared counter before a transaction is posted,
+    # or the next 'count' numbers for that many transactions posted one after another
+    def begin_transaction(self, count=1):
+        self.check_writable()
+        self.transaction = self.allocator.allocate(self.transaction, count)
+
+    # what rollback needs to undo postings that fail partway:
+    # (ledger rows, next transaction number, {asset number: exchange-rate record})
+    def checkpoint(self):
+        self.wait_for_ledger()
+        records = {number: dict(entry[1]) for number, entry in self.settings['accounts']['assets'].items()
+                   if isinstance(entry[1], dict)}
+        return len(self.ledger), self.transaction, records
+
+    # drops the rows posted since checkpoint() was taken, with everything indexed from them,
+    # and puts the exchange-rate records back as they were
+    def rollback(self, checkpoint):
+        rows, transaction, records = checkpoint
+        assets = self.settings['accounts']['assets']
+        for number, record in records.items():
+            assets[number][1].clear()
+            assets[number][1].update(record)
+        if len(self.ledger) > rows:
+            self.logger.info("Rolling back %s unsaved rows.", len(self.ledger) - rows)
+            ledger = self.ledger[:rows]
+            if isinstance(self.ledger, ColumnarLedger):
+                ledger = ColumnarLedger(ledger)
+            self.install_ledger(ledger)
+        self.transaction = transaction
 
     def add_fund(self, number, name, whole_percent=None, amount=None):
         source = []
@@ -145,37 +479,32 @@ class BaseProgram:
                 if number not in self.settings['accounts']['assets']:
                     source = self.settings['accounts']['assets']
                 else:
-                    mbox(_('Error'), _('Error: Account number is already in use.'),
-                         b1=_('Ok'), b2=None)
                     self.logger.warning("Error: Account number is already in use.")
+                    raise AccountError(_('Error: Account number is already in use.'))
             elif number[0] == '2':
                 if number not in self.settings['accounts']['liabilities']:
                     source = self.settings['accounts']['liabilities']
                 else:
-                    mbox(_('Error'), _('Error: Account number is already in use.'),
-                         b1=_('Ok'), b2=None)
                     self.logger.warning("Error: Account number is already in use.")
+                    raise AccountError(_('Error: Account number is already in use.'))
             elif number[0] == '3':
                 if number not in self.settings['accounts']['equities']:
                     source = self.settings['accounts']['equities']
                 else:
-                    mbox(_('Error'), _('Error: Account number is already in use.'),
-                         b1=_('Ok'), b2=None)
                     self.logger.warning("Error: Account number is already in use.")
+                    raise AccountError(_('Error: Account number is already in use.'))
             elif number[0] == '4':
                 if number not in self.settings['accounts']['revenues']:
                     source = self.settings['accounts']['revenues']
                 else:
-                    mbox(_('Error'), _('Error: Account number is already in use.'),
-                         b1=_('Ok'), b2=None)
                     self.logger.warning("Error: Account number is already in use.")
+                    raise AccountError(_('Error: Account number is already in use.'))
             elif number[0] == '6':
                 if number not in self.settings['accounts']['expenses']:
                     source = self.settings['accounts']['expenses']
                 else:
-                    mbox(_('Error'), _('Error: Account number is already in use.'),
-                         b1=_('Ok'), b2=None)
                     self.logger.warning("Error: Account number is already in use.")
+                    raise AccountError(_('Error: Account number is already in use.'))
 
             # percent & amount signifiers
             if whole_percent is not None:
@@ -189,6 +518,7 @@ class BaseProgram:
             self.logger.info("Added fund %s", number)
 
     def add_income(self, date, debit, credit, deb_amount, cred_amount, memo, payee=None):
+        self.begin_transaction()
         # if there is one debit fund and one credit fund
         if isinstance(debit, str) and isinstance(credit, str):
             # if the debit is a alternate currency with exrate
@@ -232,14 +562,13 @@ class BaseProgram:
                 self.credit_ledger(self.transaction, date, credit[x], cred_amount[x], memo, None, payee)
 
         elif isinstance(debit, list) and isinstance(credit, list):
-            mbox(_('Inappropriate Transaction'),
-                 _('Please separate this request into multiple transactions.'),
-                 b1=_('Ok'), b2=None)
             self.logger.warning('Attempted to input multiple incomes.')
+            raise TransactionError(_('Please separate this request into multiple transactions.'))
 
         self.transaction += 1
 
     def add_expense(self, date, debit, credit, deb_amount, cred_amount, memo, payee=None):
+        self.begin_transaction()
         # if there is one asset and one equity
         if isinstance(credit, str) and isinstance(debit, str):
             # if the asset is a alternate currency with exrate
@@ -283,6 +612,7 @@ class BaseProgram:
         self.transaction += 1
 
     def add_transfer(self, date, from_fund, to_fund, from_amount, to_amount, memo):
+        self.begin_transaction()
         payee = None
         # if splitting one fund into two or more funds
         if isinstance(from_fund, str) and isinstance(to_fund, list):
@@ -303,6 +633,7 @@ class BaseProgram:
         self.transaction += 1
 
     def add_exchange(self, date, debit, credit, deb_amount, cred_amount, memo, payee=None):
+        self.begin_transaction()
         # if there is one debit fund and one credit fund (which there should always only be one
         if isinstance(debit, str) and isinstance(credit, str):
             # if the debit is a alternate currency with exrate
@@ -319,13 +650,13 @@ class BaseProgram:
                 self.credit_ledger(self.transaction, date, credit, cred_amount, memo, None, payee)
         # if there is more than one debit fund
         else:
-            mbox(_('Error'), _('Exchanges are limited to two currencies.'),
-                 b1=_('Ok'), b2=None)
             self.logger.warning("We limit an exchange between two currencies.")
+            raise TransactionError(_('Exchanges are limited to two currencies.'))
 
         self.transaction += 1
 
     def add_offering(self, date, currencies, amount, memo):
+        self.begin_transaction()
         operating_funds = D('0.00')
 
         # calculate income from currencies & amounts entered
@@ -396,149 +727,260 @@ class BaseProgram:
             record[string_rate] = D(amount)
 
     # checking for and removing cash amounts from alt. currency
-    def subtract_from_alt_currency_records(self, fund, amount, exrate):
+    # raises InsufficientFundsError unless there is enough at that rate or force is set
+    def subtract_from_alt_currency_records(self, fund, amount, exrate, force=False):
         # this information is understood in a dictionary where
         # {'string exrate':Decimal(value)}
         record = self.settings['accounts']['assets'][fund[:4]][1]
         string_rate = str(exrate)  # this may be redundant, but we want the key to be a numerical string
         if string_rate in record.keys():  # if the exrate exists
-            if record[string_rate] - D(amount) < 0:
-                name = fund[:4]
-                question = mbox(_('Insufficient Funds'),
-                                _('There is not enough in the {} account for that rate.'
-                                  '\nWould you like to continue anyway?').format(name),
-                                b1=_('Yes'), b2=_('No'))
-                if question:
-                    record[string_rate] = D(record[string_rate]) - D(amount)
-                    return True
-                else:
-                    return False
-            else:
-                record[string_rate] = D(record[string_rate]) - D(amount)
-                return True
+            if record[string_rate] - D(amount) < 0 and not force:
+                raise InsufficientFundsError(_('There is not enough in the {} account for that rate.')
+                                             .format(fund[:4]), fund=fund[:4])
+            record[string_rate] = D(record[string_rate]) - D(amount)
+            return True
         else:  # if the exrate does not exist
-            question = mbox(_('Insufficient Funds'),
-                            _('There is no exchange rate for {}.'
-                              '\nWould you like to continue anyway?').format(string_rate),
-                            b1=_('Yes'), b2=_('No'))
-            if question:
-                record[string_rate] = D(amount)
-                return True
-            else:
-                return False
+            if not force:
+                raise InsufficientFundsError(_('There is no exchange rate for {}.').format(string_rate),
+                                             fund=fund[:4], exrate=string_rate)
+            record[string_rate] = D(amount)
+            return True
 
     def load_fund(self, fund_name):
-        balance = D('0.00')
-        tally = []
         # ledger_array = [trans#, date, account, base, debit, credit, exrate, memo, payee]
         # Fund_array = [trans#, date, amount, exrate, balance, memo, payee]
-        if fund_name in self.settings['accounts']['assets']:
-            for x in self.ledger:
-                if fund_name in x[2]:
-                    amount = (D(x[4]) + D((-x[5]))).quantize(self.cents, decimal.ROUND_HALF_UP)
-                    if x[6] is not None:
-                        exrate = D(x[6])
-                    else:
-                        exrate = x[6]
-                    balance += amount
-                    tally.append([x[0], x[1], amount, exrate, balance, x[7], x[8]])
-        elif fund_name in self.settings['accounts']['liabilities']:
-            for x in self.ledger:
-                if fund_name in x[2]:
-                    amount = (D((-x[4])) + D(x[5])).quantize(self.cents, decimal.ROUND_HALF_UP)
-                    if x[6] is not None:
-                        exrate = D(x[6])
-                    else:
-                        exrate = x[6]
-                    balance += amount
-                    tally.append([x[0], x[1], amount, exrate, balance, x[7], x[8]])
-        elif fund_name in self.settings['accounts']['equities']:
-            for x in self.ledger:
-                if fund_name in x[2]:
-                    amount = (D((-x[4])) + D(x[5])).quantize(self.cents, decimal.ROUND_HALF_UP)
-                    if x[6] is not None:
-                        exrate = D(x[6])
-                    else:
-                        exrate = x[6]
-                    balance += amount
-                    tally.append([x[0], x[1], amount, exrate, balance, x[7], x[8]])
-        elif fund_name in self.settings['accounts']['revenues']:
-            for x in self.ledger:
-                if fund_name in x[2]:
-                    amount = (D((-x[4])) + D(x[5])).quantize(self.cents, decimal.ROUND_HALF_UP)
-                    if x[6] is not None:
-                        exrate = D(x[6])
-                    else:
-                        exrate = x[6]
-                    balance += amount
-                    tally.append([x[0], x[1], amount, exrate, balance, x[7], x[8]])
-        elif fund_name in self.settings['accounts']['expenses']:
-            for x in self.ledger:
-                if fund_name in x[2]:
-                    amount = (D(x[4]) + D((-x[5]))).quantize(self.cents, decimal.ROUND_HALF_UP)
-                    if x[6] is not None:
-                        exrate = D(x[6])
-                    else:
-                        exrate = x[6]
-                    balance += amount
-                    tally.append([x[0], x[1], amount, exrate, balance, x[7], x[8]])
+        accounts = self.settings['accounts']
+        if fund_name in accounts['assets'] or fund_name in accounts['expenses']:
+            sign = 1  # debits add to these funds
+        elif fund_name in accounts['liabilities'] or fund_name in accounts['equities'] \
+                or fund_name in accounts['revenues']:
+            sign = -1
         else:
-            mbox(_('Error'), _('Error: %s is not a fund number.') % fund_name,
-                 b1=_('Ok'), b2=None)
             self.logger.warning("%s is not a fund number.", fund_name)
-        return tally
-
-    def calculate_balance_sheet(self):
+            raise AccountError(_('Error: %s is not a fund number.') % fund_name)
+        exponent = self.fund_exponent(fund_name)
+        balances = None
+        store = self.indexed_store()
+        if store is not None:
+            rows = store.fund_rows(fund_name)
+            # a posting has one side and the other is 0, so the difference is exact
+            amounts = [to_units(row[4] - row[5], exponent) for row in rows]
+        else:
+            self.wait_for_ledger()
+            positions = self.account_index.get(fund_name, [])
+            if exponent == EXPONENT:
+                # self.arrays already holds every debit and credit in whole cents
+                self.arrays.update(self.ledger)
+                # this may run on the page worker: rows posted meanwhile are left for the next call
+                positions = positions[:bisect.bisect_left(positions, self.arrays.rows)]
+                amounts = fund_cents(self.arrays, positions)
+                balances = running_balances(self.arrays, fund_name, sign, positions)
+            else:
+                positions = positions[:bisect.bisect_left(positions, len(self.ledger))]
+                amounts = [to_units(self.ledger[position][4] - self.ledger[position][5], exponent)
+                           for position in positions]
+            rows = [self.ledger[position] for position in positions]
+        amounts = [amount * sign for amount in amounts]
+        if balances is None:
+            # in minor units, so the running balance is integer adds
+            balances = [from_units(balance, exponent) for balance in itertools.accumulate(amounts)]
+        return [[x[0], x[1], from_units(amount, exponent), None if x[6] is None else D(x[6]), balance, x[7], x[8]]
+                for x, amount, balance in zip(rows, amounts, balances)]
+
+    # minor-unit digits of the fund's amounts: an alternate currency asset's own currency,
+    # and the base currency (that of 1010) for every other fund
+    def fund_exponent(self, number):
+        assets = self.settings['accounts']['assets']
+        if number not in assets:
+            number = '1010'
+        try:
+            return exponent(assets[number][0][-3:])
+        except KeyError:  # no base currency chosen yet
+            return EXPONENT
+
+    # the balance sheet now, or as of the end of a 'DD/MM/YYYY' date
+    def calculate_balance_sheet(self, date=None):
+        self.wait_for_ledger()
+        if date is None:
+            balances = self.balances
+        else:
+            balances = self.balances_as_of(date)
         # assets
         asset = []
         for fund in self.settings['accounts']['assets']:
             if fund == '1010':
-                try:
-                    asset.append((self.get_asset_fullname(fund),
-                                  self.load_fund(fund)[-1][4]))
-                except IndexError:
+                if self.has_postings(fund, balances):
+                    asset.append((self.get_asset_fullname(fund), self.fund_balance(fund, balances)))
+                else:
                     asset.append((self.get_asset_fullname(fund), 0))
             else:
-                try:
-                    asset.append((self.get_asset_fullname(fund),
-                                  (self.load_fund(fund)[-1][4], self.load_fund(fund)[-1][1])))
-                except IndexError:
+                if self.has_postings(fund, balances):
+                    # (balance in its own currency, exchange rate of its latest posting)
+                    asset.append((self.get_asset_fullname(fund), (self.fund_balance(fund, balances),
+                                                                  self.last_rate(fund, date))))
+                else:
                     asset.append((self.get_asset_fullname(fund), (0, 0)))
         # liabilies
         liability = []
         for fund in self.settings['accounts']['liabilities']:
-            try:
-                liability.append((self.get_liability_fullname(fund),
-                                  self.load_fund(fund)[-1][4]))
-            except IndexError:
-                liability.append((self.get_liability_fullname(fund), 0))
+            liability.append((self.get_liability_fullname(fund), self.closing_balance(fund, balances)))
         # equities
         equity = []
         for fund in self.settings['accounts']['equities']:
-            try:
-                equity.append((self.get_equity_fullname(fund),
-                               self.load_fund(fund)[-1][4]))
-            except IndexError:
-                equity.append((self.get_equity_fullname(fund), 0))
+            equity.append((self.get_equity_fullname(fund), self.closing_balance(fund, balances)))
         # revenues
         revenue = []
         for fund in self.settings['accounts']['revenues']:
-            try:
-                revenue.append((self.get_revenue_fullname(fund),
-                                self.load_fund(fund)[-1][4]))
-            except IndexError:
-                revenue.append((self.get_revenue_fullname(fund), 0))
+            revenue.append((self.get_revenue_fullname(fund), self.closing_balance(fund, balances)))
         # expenses
         expense = []
         for fund in self.settings['accounts']['expenses']:
-            try:
-                expense.append((self.get_expense_fullname(fund),
-                                self.load_fund(fund)[-1][4]))
-            except IndexError:
-                expense.append((self.get_expense_fullname(fund), 0))
+            expense.append((self.get_expense_fullname(fund), self.closing_balance(fund, balances)))
 
         return [asset, liability, equity, revenue, expense]
 
+    # Every fund's activity in a period, from one pass over the rows dated in it:
+    # {number: {'opening', 'debits', 'credits', 'closing', 'positions'}}, amounts as Decimals
+    # with opening and closing as debits minus credits, and positions in date order.
+    # start and end are 'DD/MM/YYYY' dates, both included; None leaves that end open.
+    # Every period report reads this, and it is kept until the ledger changes.
+    def period_activity(self, start=None, end=None):
+        self.wait_for_ledger()
+        cached = self.activity_cache.get((start, end))
+        if cached is not None and cached[0] == self.ledger_version:
+            return cached[1]
+        arrays = self.arrays
+        arrays.update(self.ledger)
+        first = None if start is None else as_of_ordinal(start) - 1
+        last = None if end is None else as_of_ordinal(end)
+        opening = {} if first is None else self.period_closes.balances_as_of(first, arrays, self.date_index)
+        moved = {}
+        for position in self.date_index.positions_between(first, last):
+            number = arrays.numbers[arrays.accounts[position]]
+            try:
+                fund = moved[number]
+            except KeyError:
+                fund = moved[number] = [0, 0, []]
+            fund[0] += int(arrays.debits[position])
+            fund[1] += int(arrays.credits[position])
+            fund[2].append(position)
+        activity = {}
+        for number in set(opening) | set(moved):
+            debits, credits, positions = moved.get(number, (0, 0, []))
+            before = opening.get(number, 0)
+            activity[number] = {'opening': from_units(before),
+                                'debits': from_units(debits),
+                                'credits': from_units(credits),
+                                'closing': from_units(before + debits - credits),
+                                'positions': positions}
+        self.activity_cache[(start, end)] = (self.ledger_version, activity)
+        return activity
+
+    # [(start, end), [(revenue fund, amount)], [(expense fund, amount)]] for a (start, end) period
+    def calculate_income_statement(self, period):
+        activity = self.period_activity(*period)
+        nothing = {'debits': D('0.00'), 'credits': D('0.00')}
+        revenue = []
+        for fund in self.settings['accounts']['revenues']:
+            moved = activity.get(fund, nothing)
+            revenue.append((self.get_revenue_fullname(fund), moved['credits'] - moved['debits']))
+        expense = []
+        for fund in self.settings['accounts']['expenses']:
+            moved = activity.get(fund, nothing)
+            expense.append((self.get_expense_fullname(fund), moved['debits'] - moved['credits']))
+        return [period, revenue, expense]
+
+    # [(start, end), [(fund, opening, rows, closing)]] for every fund used by the end of the
+    # period, where rows are (trans#, date, memo, amount, balance) in the fund's normal sign
+    def calculate_fund_statements(self, period):
+        activity = self.period_activity(*period)
+        statements = []
+        for category in self.settings['accounts']:
+            # assets and expenses grow with debits, everything else with credits
+            sign = 1 if category in ('assets', 'expenses') else -1
+            for fund in self.settings['accounts'][category]:
+                if fund not in activity:
+                    continue
+                moved = activity[fund]
+                balance = moved['opening'] * sign
+                rows = []
+                for position in moved['positions']:
+                    x = self.ledger[position]
+                    amount = from_units(sign * int(self.arrays.debits[position] - self.arrays.credits[position]))
+                    balance += amount
+                    rows.append((x[0], x[1], x[7], amount, balance))
+                name = '{} {}'.format(fund, self.settings['accounts'][category][fund][0])
+                statements.append((name, moved['opening'] * sign, rows, moved['closing'] * sign))
+        return [period, statements]
+
+    # the data buildreports.run_reports hands its workers, {(church, report, period): data},
+    # for every report type and period asked for. The balance sheet takes a 'DD/MM/YYYY' date
+    # (None for now), the income statement and fund statements a (start, end) pair
+    def report_snapshot(self, reports, periods=(None,)):
+        builders = {'balance_sheet': self.calculate_balance_sheet,
+                    'income_statement': self.calculate_income_statement,
+                    'fund_statements': self.calculate_fund_statements}
+        church = self.settings['Church Name']
+        return {(church, report, period): builders[report](period) for report in reports for period in periods}
+
+    # closing balance for reports: 0 if the fund has never been used
+    def closing_balance(self, number, balances=None):
+        if self.has_postings(number, balances):
+            return self.fund_balance(number, balances)
+        else:
+            return 0
+
+    # {account number: debits minus credits} at the end of a 'DD/MM/YYYY' date,
+    # from the nearest month-end close plus the rows dated after it
+    def balances_as_of(self, date):
+        self.wait_for_ledger()
+        self.arrays.update(self.ledger)
+        cents = self.period_closes.balances_as_of(as_of_ordinal(date), self.arrays, self.date_index)
+        return {number: from_units(amount) for number, amount in cents.items()}
+
+    # position of the fund's latest row, or its latest row dated on or before 'date'
+    def last_posting(self, number, date=None):
+        positions = self.account_index[number]
+        if date is None:
+            return positions[-1]
+        ordinal = as_of_ordinal(date)
+        self.arrays.update(self.ledger)
+        for position in reversed(positions):
+            if 0 <= self.arrays.ordinals[position] <= ordinal:
+                return position
+        return positions[-1]
+
+    # Exchange rate of the fund's latest posting, on or before date, that has one. A fund with
+    # none (e.g. only transfers) takes the latest rate in its exchange-rate record that still
+    # holds money, and without that None, which the balance sheet counts as 0 in the base currency.
+    def last_rate(self, number, date=None):
+        positions = self.account_index[number]
+        latest = bisect.bisect_right(positions, self.last_posting(number, date))
+        for position in reversed(positions[:latest]):
+            rate = self.ledger[position][6]
+            if rate is not None:
+                return rate
+        record = self.settings['accounts']['assets'][number][1]
+        if isinstance(record, dict):
+            rates = [rate for rate, amount in record.items() if D(amount) > 0] or list(record)
+            if rates:
+                return D(rates[-1])
+        self.logger.warning("%s has no exchange rate; it counts as 0 on the balance sheet.", number)
+        return None
+
+    # closes every finished month and writes the closes next to the ledger
+    def save_period_closes(self):
+        if self.close_periods():
+            self.period_closes.save(len(self.ledger))
+
+    # closes every finished month in memory; False if there is nothing dated to close
+    def close_periods(self):
+        if self.date_index.first() is None:
+            return False
+        self.arrays.update(self.ledger)
+        self.period_closes.close_through(closed_month_end(self.date_index.ordinals[-1]), self.arrays, self.date_index)
+        return True
+
     def get_fund_amounts(self):
         amount = []
         for category in self.settings['accounts']:
@@ -561,35 +1003,59 @@ class BaseProgram:
                                         self.settings['accounts'][category][key][1]))
         return percent
 
+    # A posting's amount and its base-currency value, each rounded once in the minor units
+    # of its currency (see money.py). The exponents are looked up once per posting.
+    def posting_amounts(self, number, amount, exrate=None):
+        digits = self.fund_exponent(number)
+        amt = from_units(to_units(amount, digits), digits)
+        if exrate is None:
+            return amt, amt
+        base_digits = digits if number == '1010' else self.fund_exponent('1010')
+        return amt, from_units(to_units(amount, base_digits, exrate), base_digits)
+
     def debit_ledger(self, trans, date, account, amount, memo, exrate=None, payee=None):
-        if exrate is not None:
-            base = (D(amount) * D(exrate)).quantize(self.cents, decimal.ROUND_HALF_UP)
-            exrate2 = D(exrate)
-        else:
-            base = D(amount).quantize(self.cents, decimal.ROUND_HALF_UP)
-            exrate2 = None
-        amt = D(amount).quantize(self.cents, decimal.ROUND_HALF_UP)
+        number = account_number(account)
+        amt, base = self.posting_amounts(number, amount, exrate)
+        exrate2 = None if exrate is None else D(exrate)
+        self.wait_for_ledger()
+        self.account_index.setdefault(number, []).append(len(self.ledger))
+        index_transaction(self.transaction_index, trans, len(self.ledger))
+        ordinal = date_ordinal(date)
+        self.date_index.add(ordinal, len(self.ledger))
+        self.period_closes.invalidate(ordinal)
+        self.balances[number] = self.balances.get(number, D('0.00')) + amt
         self.ledger.append([trans, date, account, base, amt, 0, exrate2, memo, payee])
+        self.search_index.add_row(self.ledger[-1])
+        self.ledger_version += 1
 
     def credit_ledger(self, trans, date, account, amount, memo, exrate=None, payee=None):
-        if exrate is not None:
-            base = (D(amount) * D(exrate)).quantize(self.cents, decimal.ROUND_HALF_UP)
-            exrate2 = D(exrate)
-        else:
-            base = D(amount).quantize(self.cents, decimal.ROUND_HALF_UP)
-            exrate2 = None
-        amt = D(amount).quantize(self.cents, decimal.ROUND_HALF_UP)
+        number = account_number(account)
+        amt, base = self.posting_amounts(number, amount, exrate)
+        exrate2 = None if exrate is None else D(exrate)
+        self.wait_for_ledger()
+        self.account_index.setdefault(number, []).append(len(self.ledger))
+        index_transaction(self.transaction_index, trans, len(self.ledger))
+        ordinal = date_ordinal(date)
+        self.date_index.add(ordinal, len(self.ledger))
+        self.period_closes.invalidate(ordinal)
+        self.balances[number] = self.balances.get(number, D('0.00')) - amt
         self.ledger.append([trans, date, account, base, 0, amt, exrate2, memo, payee])
+        self.search_index.add_row(self.ledger[-1])
+        self.ledger_version += 1
 
     def save_to_file(self, ledg, configs):
         self.settings['payee_names'] = self.payee_names
-        # save settings to file
-        with open('resources/settings.json', 'w+', encoding='utf-8') as doc1:
-            json.dump(configs, doc1, indent=2)
-
-        # save ledger to file
-        with open('resources/matrices.txt', 'w+', encoding='utf-8') as doc2:
-            json.dump(ledg, doc2, indent=2, use_decimal=True)
+        # settings and the rows posted since the last save, committed together
+        self.save(configs)
+
+    # saves settings on their own, e.g. after a fund is added, leaving unsaved rows unsaved
+    def save_settings(self):
+        self.check_writable()
+        with self.lock:
+            self.rebase_settings()
+            data = settings_data(self.settings)
+            commit_generation(settings=data)
+            self.settings_saved(data)
 
     # figures out if there is enough funds and return true
     # get the latest fund and then subtract amount from it to see if it gets to 0
@@ -600,13 +1066,11 @@ class BaseProgram:
                 if isinstance(amount[x], tuple):  # if the amount is an alt. currency (another function checks this)
                     pass
                 else:  # If the amount isn't an alt. currency
-                    try:  # try to get the latest amount
-                        self.load_fund(fund[x][:4])[-1][4]
-                    except IndexError:  # If there is nothing in the fund
+                    if not self.has_postings(fund[x][:4]):  # If there is nothing in the fund
                         array.append(0)
                     else:
                         a = D(amount[x]).quantize(self.cents, decimal.ROUND_HALF_UP)
-                        if self.load_fund(fund[x][:4])[-1][4] - a >= D('0'):
+                        if self.fund_balance(fund[x][:4]) - a >= D('0'):
                             array.append(1)
                         else:
                             array.append(0)
@@ -614,57 +1078,96 @@ class BaseProgram:
             if isinstance(amount, tuple):  # if the amount belongs to an alt. currency (another function checks this)
                 return True
             else:  # if the amount is not an alt. currency
-                try:  # try to get the lastest amount
-                    self.load_fund(fund[:4])[-1][4]
-                except IndexError:  # if there is nothing in the fund
+                if not self.has_postings(fund[:4]):  # if there is nothing in the fund
                     array.append(0)
                 else:
                     a = D(amount).quantize(self.cents, decimal.ROUND_HALF_UP)
-                    if self.load_fund(fund[:4])[-1][4] - a >= D('0'):
+                    if self.fund_balance(fund[:4]) - a >= D('0'):
                         array.append(1)
                     else:
                         array.append(0)
         if 0 in array:
-            mbox(_('Insufficient Funds'),
-                 _('There is not enough money in a fund to continue this transaction.'),
-                 b1=_('Ok'), b2=None)
             return False
         else:
             return True
 
 
-def check_date(date):
-    if len(date) == 10:
-        if date[6:].isdigit():
-            year = int(date[6:])
-        else:
-            mbox(_('Date Error'), _('Year date needs to be four digits. (YYYY)'),
-                 b1=_('Ok'), b2=None)
-            logger.warning("Year needs to be in format YYYY")
-            return False
-        if date[3:5].isdigit():
-            month = int(date[3:5])
-        else:
-            mbox(_('Date Error'), _('Month date needs to be two digits. (MM)'),
-                 b1=_('Ok'), b2=None)
-            logger.warning("Month needs to be in format MM")
-            return False
-        if date[:2].isdigit():
-            day = int(date[:2])
-        else:
-            mbox(_('Date Error'), _('Day date needs to be two digits. (DD)'),
-                 b1=_('Ok'), b2=None)
-            logger.warning("Day needs to be in format DD")
-            return False
-        
-        try:
-            datetime.date(year, month, day)
-            return True
-        except ValueError:
-            logger.exception("The date was not readable.")
-            return False
+# widens the [first, end) row range recorded for a transaction number
+def index_transaction(transaction_index, trans, position):
+    try:
+        rows = transaction_index[trans]
+    except KeyError:
+        transaction_index[trans] = [position, position + 1]
     else:
-        mbox(_('Date Error'), _('Please enter the date in format DD/MM/YYYY.'),
-             b1=_('Ok'), b2=None)
+        rows[0] = min(rows[0], position)
+        rows[1] = max(rows[1], position + 1)
+
+
+# Three-way merge of two programs' settings: base is what both last had on disk, mine is
+# changed in place and theirs is what the other program has saved since. Exchange-rate records
+# take both programs' changes, payees and funds either one added are kept, a fund the other
+# removed goes unless it was changed here, and for anything else a change made here wins.
+def merge_settings(base, mine, theirs):
+    plain = json.loads(settings_data(mine).decode('utf-8'))  # mine as written, to compare with base
+    for key, value in theirs.items():
+        if key == 'payee_names':
+            names = mine.setdefault(key, [])
+            names.extend([name for name in value if name not in names])
+        elif key == 'accounts':
+            for category, funds in value.items():
+                merge_funds(base.get(key, {}).get(category, {}), mine[key].setdefault(category, {}),
+                            plain[key].get(category, {}), funds)
+        elif key not in plain or plain[key] == base.get(key):
+            mine[key] = value
+
+
+def merge_funds(base, mine, plain, theirs):
+    for number, entry in theirs.items():
+        before = base.get(number)
+        if number not in mine:
+            if before is None:  # added there
+                mine[number] = entry
+            continue
+        for field, value in enumerate(entry[:len(mine[number])]):
+            if isinstance(value, dict) and isinstance(mine[number][field], dict):
+                # an alternate currency's {rate: amount} record
+                merge_records(before[field] if before is not None else {}, mine[number][field], value)
+            elif before is not None and field < len(before) and plain[number][field] == before[field]:
+                mine[number][field] = value
+    for number in list(mine):
+        if number not in theirs and number in base and plain[number] == base[number]:
+            del mine[number]  # removed there
+
+
+# both programs' changes to the amount held at each rate
+def merge_records(base, mine, theirs):
+    for rate in list(theirs) + [rate for rate in base if rate not in theirs]:
+        change = D(to_text(theirs.get(rate, 0))) - D(to_text(base.get(rate, 0)))
+        if change:
+            mine[rate] = D(to_text(mine.get(rate, 0))) + change
+
+
+# The ledger records accounts as '<number> <name>'; this returns the number
+def account_number(account):
+    return account.split(' ', 1)[0]
+
+
+# raises DateError unless the date is a real date written DD/MM/YYYY
+def validate_date(date):
+    if len(date) != 10:
         logger.warning("Please enter date in format DD/MM/YYYY")
-        return False
+        raise DateError(_('Please enter the date in format DD/MM/YYYY.'))
+    if not date[6:].isdigit():
+        logger.warning("Year needs to be in format YYYY")
+        raise DateError(_('Year date needs to be four digits. (YYYY)'))
+    if not date[3:5].isdigit():
+        logger.warning("Month needs to be in format MM")
+        raise DateError(_('Month date needs to be two digits. (MM)'))
+    if not date[:2].isdigit():
+        logger.warning("Day needs to be in format DD")
+        raise DateError(_('Day date needs to be two digits. (DD)'))
+    try:
+        return datetime.date(int(date[6:]), int(date[3:5]), int(date[:2]))
+    except ValueError:
+        logger.warning("The date %s was not readable.", date)
+        raise DateError(_('Please enter a real date.'))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# Posts many transactions at once without going through the windows, e.g.
+#   python batchimport.py offerings.csv
+#
+# CSV files hold one posting per line under the header
+#   ref,date,account,debit,credit,exrate,memo,payee
+# and the lines sharing a ref make up one transaction.
+# JSON-lines files hold one transaction per line:
+#   {"date": "05/01/2020", "memo": "Sunday offering", "payee": null,
+#    "postings": [{"account": "1010", "debit": "120.00"},
+#                 {"account": "3000", "credit": "120.00"}]}
+# Accounts may be given by number ('1010') or in full ('1010 Cash UAH').
+# The whole file is checked before anything is posted, posted all or nothing, and the ledger is saved once.
+
+from errors import LedgerError
+from storage import date_ordinal
+import simplejson as json
+import argparse
+import csv
+import decimal
+import logging
+import sys
+
+# Logging Set Up
+logger = logging.getLogger(__name__)
+
+D = decimal.Decimal
+CENTS = D('.01')
+COLUMNS = ('ref', 'date', 'account', 'debit', 'credit', 'exrate', 'memo', 'payee')
+
+
+# Raised with every problem found in a file, so it can be fixed in one go.
+class BatchError(LedgerError):
+
+    def __init__(self, errors):
+        self.errors = errors  # [(line, message)]
+        super().__init__('\n'.join('line {}: {}'.format(line, message) for line, message in errors))
+
+
+# [{'line', 'date', 'memo', 'payee', 'postings': [{'line', 'account', 'debit', 'credit', 'exrate'}]}]
+def read_csv(path):
+    transactions = {}
+    with open(path, 'r', encoding='utf-8', newline='') as doc:
+        reader = csv.DictReader(doc)
+        missing = [column for column in COLUMNS if column not in (reader.fieldnames or ())]
+        if missing:
+            raise BatchError([(1, 'missing column(s): {}'.format(', '.join(missing)))])
+        for line, entry in enumerate(reader, 2):
+            entry = {key: (value.strip() if value else None) for key, value in entry.items()}
+            if entry['ref'] not in transactions:
+                transactions[entry['ref']] = {'line': line, 'date': entry['date'], 'memo': entry['memo'],
+                                              'payee': entry['payee'], 'postings': []}
+            transaction = transactions[entry['ref']]
+            if entry['date'] != transaction['date']:
+                transaction.setdefault('errors', []).append(
+                    (line, 'ref {} is dated both {} and {}'.format(entry['ref'], transaction['date'], entry['date'])))
+            transaction['postings'].append({'line': line, 'account': entry['account'], 'debit': entry['debit'],
+                                            'credit': entry['credit'], 'exrate': entry['exrate']})
+    return list(transactions.values())
+
+
+def read_jsonl(path):
+    transactions = []
+    errors = []
+    with open(path, 'r', encoding='utf-8') as doc:
+        for line, text in enumerate(doc, 1):
+            if not text.strip():
+                continue
+            try:
+                entry = json.loads(text, use_decimal=True)
+                postings = [{'line': line, 'account': posting.get('account'), 'debit': posting.get('debit'),
+                             'credit': posting.get('credit'), 'exrate': posting.get('exrate')}
+                            for posting in entry['postings']]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                errors.append((line, 'not a transaction'))
+                continue
+            transactions.append({'line': line, 'date': entry.get('date'), 'memo': entry.get('memo'),
+                                 'payee': entry.get('payee'), 'postings': postings})
+    if errors:
+        raise BatchError(errors)
+    return transactions
+
+
+# reads a .csv file, or a JSON-lines file for anything else unless kind says otherwise
+def read_transactions(path, kind=None):
+    if kind is None:
+        kind = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    if kind == 'csv':
+        return read_csv(path)
+    else:
+        return read_jsonl(path)
+
+
+# Checks every transaction against the program's chart of accounts and returns them ready
+# to post, with full account names and Decimal amounts. Raises BatchError listing every problem:
+# unreadable dates, unknown accounts, bad amounts and, if balanced, debits that don't equal credits.
+def validate(program, transactions, balanced=True):
+    accounts = program.settings['accounts']
+    names = {number: '{} {}'.format(number, entry[0])
+             for category in accounts for number, entry in accounts[category].items()}
+    errors = []
+    ready = []
+    for transaction in transactions:
+        errors.extend(transaction.get('errors', []))
+        line = transaction['line']
+        date = transaction['date']
+        if not isinstance(date, str) or len(date) != 10 or date_ordinal(date) is None:
+            errors.append((line, 'date {!r} is not DD/MM/YYYY'.format(date)))
+        if not transaction['postings']:
+            errors.append((line, 'no postings'))
+        postings = []
+        debits = credits = D('0.00')
+        for posting in transaction['postings']:
+            number = str(posting['account'] or '').split(' ', 1)[0]
+            if number not in names:
+                errors.append((posting['line'], 'unknown account {!r}'.format(posting['account'])))
+                continue
+            debit = amount(posting['debit'])
+            credit = amount(posting['credit'])
+            exrate = amount(posting['exrate'], places=None)
+            if debit is False or credit is False or exrate is False:
+                errors.append((posting['line'], 'amounts must be positive numbers'))
+                continue
+            if (debit is None) == (credit is None):
+                errors.append((posting['line'], 'give either a debit or a credit'))
+                continue
+            # only the alternate-currency asset funds carry an exchange rate
+            alternate = number in accounts['assets'] and number != '1010'
+            if alternate and exrate is None:
+                errors.append((posting['line'], '{} needs an exchange rate'.format(names[number])))
+                continue
+            if not alternate and exrate is not None:
+                errors.append((posting['line'], '{} does not take an exchange rate'.format(names[number])))
+                continue
+            value = debit if debit is not None else credit
+            base = value if exrate is None else (value * exrate).quantize(CENTS, decimal.ROUND_HALF_UP)
+            if debit is not None:
+                debits += base
+            else:
+                credits += base
+            postings.append((names[number], debit, credit, exrate))
+        if balanced and postings and len(postings) == len(transaction['postings']) and debits != credits:
+            errors.append((line, 'debits {} do not equal credits {}'.format(debits, credits)))
+        ready.append((date, postings, transaction['memo'], transaction['payee']))
+    if errors:
+        raise BatchError(errors)
+    return ready
+
+
+# text or number -> Decimal, None if empty, False if it isn't a positive number
+def amount(value, places=CENTS):
+    if value is None or value == '':
+        return None
+    try:
+        number = D(str(value))
+    except decimal.InvalidOperation:
+        return False
+    if not number.is_finite() or number <= 0:
+        return False
+    if places is not None:
+        number = number.quantize(places, decimal.ROUND_HALF_UP)
+    return number
+
+
+# Posts validated transactions one after another under consecutive transaction numbers,
+# all taken from the shared counter at once. If anything fails, nothing stays posted.
+def post(program, ready):
+    if not ready:
+        return
+    checkpoint = program.checkpoint()
+    try:
+        program.begin_transaction(len(ready))
+        for date, postings, memo, payee in ready:
+            for account, debit, credit, exrate in postings:
+                if debit is not None:
+                    if exrate is not None:
+                        program.add_to_alt_currency_records(account, debit, exrate)
+                    program.debit_ledger(program.transaction, date, account, debit, memo, exrate, payee)
+                else:
+                    if exrate is not None:
+                        program.add_to_alt_currency_records(account, -credit, exrate)
+                    program.credit_ledger(program.transaction, date, account, credit, memo, exrate, payee)
+            program.transaction += 1
+    except Exception:
+        program.rollback(checkpoint)
+        raise
+
+
+# reads, checks and posts a whole file, then saves once; returns the number of transactions
+def import_file(program, path, kind=None, dry_run=False):
+    ready = validate(program, read_transactions(path, kind))
+    if not dry_run:
+        post(program, ready)
+        program.save_to_file(program.ledger, program.settings)
+        logger.info("Imported %s transactions from %s.", len(ready), path)
+    return len(ready)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Post a file of transactions to the CFAP ledger.')
+    parser.add_argument('path', help='CSV or JSON-lines file of transactions')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='file format (default: from the extension)')
+    parser.add_argument('--dry-run', action='store_true', help='check the file without posting anything')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from backend import BaseProgram
+    program = BaseProgram()
+    try:
+        count = import_file(program, args.path, args.format, args.dry_run)
+    except LedgerError as error:  # a BatchError listing the file's problems, or a failed save
+        print(error, file=sys.stderr)
+        return 1
+    print('{} transactions {}.'.format(count, 'checked' if args.dry_run else 'imported'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+# A compact binary ledger snapshot, an alternative to the JSON array in matrices.txt that
+# loads without parsing text or building a Decimal per amount. Chosen with the setting
+#   "snapshot_format": "binary"
+# and converted to or from JSON, which stays the format for export and interchange, with
+#   python binformat.py to-json resources/ledger.bin ledger.json
+#   python binformat.py from-json resources/matrices.txt resources/ledger.bin
+# and a folder of it with its settings.json, for opening read-only (BaseProgram(archive=...)), with
+#   python binformat.py archive resources archives/2019
+#
+# Layout, all little-endian:
+#   header     magic, version, rows, strings, odd dates (HEADER)
+#   columns    one fixed-width block per ColumnarLedger column, in COLUMNS order:
+#              trans# int64, date ordinal int32, account int32, base/debit/credit int64 cents,
+#              exrate/memo/payee int32 (-1 for none). Strings are numbers in the string table.
+#   odd dates  positions (int64) and string numbers (int32) of dates that aren't DD/MM/YYYY
+#   strings    count + 1 uint64 offsets into the UTF-8 text that follows them
+# Every block starts on an 8-byte boundary, so a mapped file can be read in place.
+
+from columnar import ColumnarLedger
+from storage import JournalStore, stage_file, commit_generation, read_manifest, committed_snapshot, checksum, \
+    FileLock
+import simplejson as json
+import argparse
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+from array import array
+
+# NumPy is optional: without it a mapped ledger is indexed with plain Python loops
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Logging Set Up
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CFAPLDG\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQ')  # magic, version, (unused), rows, strings, odd dates
+COLUMNS = (('trans', 'q'), ('dates', 'i'), ('accounts', 'i'), ('base', 'q'), ('debit', 'q'),
+           ('credit', 'q'), ('exrates', 'i'), ('memos', 'i'), ('payees', 'i'))
+SWAP = sys.byteorder != 'little'
+ARCHIVE_LEDGER = 'ledger.bin'  # file names inside an archive folder
+ARCHIVE_SETTINGS = 'settings.json'
+
+
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def padded(size):
+    return (size + 7) // 8 * 8
+
+
+# the first 'rows' rows of a ledger (a list of rows or a ColumnarLedger) as snapshot bytes
+def pack(ledger, rows=None):
+    if rows is None:
+        rows = len(ledger)
+    if not isinstance(ledger, ColumnarLedger):
+        ledger = ColumnarLedger(ledger[:rows])
+    # This may run on the autosave thread while rows are posted, so nothing here changes
+    # the ledger. The string table only ever grows, so a copy taken now holds every string
+    # the first 'rows' rows use; odd dates not in it yet are added to the copy, not the ledger.
+    strings = list(ledger.strings.strings)
+    copied = len(strings)
+    known = ledger.strings.ids
+    odd_dates = dict(ledger.odd_dates)
+    odd = sorted(position for position in odd_dates if position < rows)
+    odd_ids = array('i')
+    added = {}
+    for position in odd:
+        text = odd_dates[position]
+        number = known.get(text, copied)
+        if number >= copied:  # not in the copy, or interned since it was taken
+            number = added.get(text)
+            if number is None:
+                number = added[text] = len(strings)
+                strings.append(text)
+        odd_ids.append(number)
+    parts = [HEADER.pack(MAGIC, VERSION, 0, rows, len(strings), len(odd))]
+    blocks = [getattr(ledger, name)[:rows] for name, code in COLUMNS]
+    blocks.append(array('q', odd))
+    blocks.append(odd_ids)
+    text = [string.encode('utf-8') for string in strings]
+    offsets = array('Q', [0])
+    for encoded in text:
+        offsets.append(offsets[-1] + len(encoded))
+    blocks.append(offsets)
+    for block in blocks:
+        if SWAP:
+            block.byteswap()
+        data = block.tobytes()
+        parts.append(data + bytes(padded(len(data)) - len(data)))
+    parts.append(b''.join(text))
+    return b''.join(parts)
+
+
+# Reads snapshot bytes, or anything else with the buffer interface such as an mmap, into
+# {'rows', 'columns': {name: memoryview}, 'odd_dates': {position: string number},
+#  'offsets': memoryview, 'text': memoryview}. The views point into buffer, nothing is copied.
+def unpack(buffer):
+    view = memoryview(buffer)
+    magic, version, unused, rows, count, odd = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError('not a binary ledger snapshot')
+    if version != VERSION:
+        raise ValueError('binary ledger snapshot version {} is not supported'.format(version))
+    at = HEADER.size
+
+    def block(code, length):
+        nonlocal at
+        size = struct.calcsize(code) * length
+        data = view[at:at + size].cast(code)
+        at += padded(size)
+        return data
+
+    columns = {name: block(code, rows) for name, code in COLUMNS}
+    positions = block('q', odd)
+    ids = block('i', odd)
+    offsets = block('Q', count + 1)
+    return {'rows': rows,
+            'columns': columns,
+            'odd_dates': dict(zip(positions.tolist(), ids.tolist())),
+            'offsets': offsets,
+            'text': view[at:at + offsets[count]]}
+
+
+# string number -> str for an unpacked snapshot
+def string_at(snapshot, number):
+    if number < 0:
+        return None
+    offsets = snapshot['offsets']
+    return str(snapshot['text'][offsets[number]:offsets[number + 1]], 'utf-8')
+
+
+# snapshot bytes -> ColumnarLedger, copying each column in one go
+def read_ledger(buffer):
+    snapshot = unpack(buffer)
+    ledger = ColumnarLedger()
+    for name, code in COLUMNS:
+        column = getattr(ledger, name)
+        column.frombytes(snapshot['columns'][name].cast('B'))
+        if SWAP:
+            column.byteswap()
+    strings = ledger.strings
+    strings.strings = [string_at(snapshot, number) for number in range(len(snapshot['offsets']) - 1)]
+    strings.ids = {string: number for number, string in enumerate(strings.strings)}
+    ledger.odd_dates = {position: strings.get(number) for position, number in snapshot['odd_dates'].items()}
+    return ledger
+
+
+# memory-maps a snapshot file, read-only
+def map_file(path):
+    with open(path, 'rb') as doc:
+        return mmap.mmap(doc.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# The strings of an unpacked snapshot, decoded the first time each is asked for.
+class MappedStrings:
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.decoded = {}
+
+    def get(self, number):
+        if number < 0:
+            return None
+        try:
+            return self.decoded[number]
+        except KeyError:
+            text = self.decoded[number] = string_at(self.snapshot, number)
+            return text
+
+
+# A binary snapshot opened read-only for viewing and reports. The columns are views into the
+# mapped file, so opening even a large archive reads next to nothing, and the pages are shared
+# by every program that has it open. Rows come out as from a ColumnarLedger; append() refuses.
+class MappedLedger(ColumnarLedger):
+
+    read_only = True
+
+    def __init__(self, path):
+        self.path = path
+        self.mapped = map_file(path)
+        snapshot = unpack(self.mapped)
+        for name, code in COLUMNS:
+            column = snapshot['columns'][name]
+            if SWAP:  # the file is little-endian, so the columns have to be copied here
+                column = array(code)
+                column.frombytes(snapshot['columns'][name].cast('B'))
+                column.byteswap()
+            setattr(self, name, column)
+        self.strings = MappedStrings(snapshot)
+        self.odd_dates = {position: self.strings.get(number) for position, number in snapshot['odd_dates'].items()}
+
+    def append(self, row):
+        raise TypeError('{} is open read-only'.format(self.path))
+
+    # {account number: positions in ledger order}, the account index for a ledger that never changes
+    def account_positions(self):
+        names = {}  # string number -> account number
+        if np is None:
+            index = {}
+            for position, number in enumerate(self.accounts):
+                if number not in names:
+                    names[number] = self.strings.get(number).split(' ', 1)[0]
+                index.setdefault(names[number], []).append(position)
+            return index
+        ids = np.frombuffer(self.accounts, dtype=np.int32)
+        order = np.argsort(ids, kind='stable')
+        ordered = ids[order]
+        starts = np.flatnonzero(np.concatenate(([True], ordered[1:] != ordered[:-1]))).tolist()
+        index = {}
+        for start, end in zip(starts, starts[1:] + [len(ids)]):
+            number = self.strings.get(int(ordered[start])).split(' ', 1)[0]
+            if number in index:  # the same fund under an older name
+                index[number] = np.sort(np.concatenate((index[number], order[start:end])))
+            else:
+                index[number] = order[start:end]
+        return index
+
+    # positions of one transaction's rows
+    def positions_of(self, trans):
+        if np is None:
+            return [position for position, number in enumerate(self.trans) if number == trans]
+        return np.flatnonzero(np.frombuffer(self.trans, dtype=np.int64) == trans)
+
+
+def to_json(source, target):
+    mapped = map_file(source)
+    try:
+        ledger = read_ledger(mapped)
+    finally:
+        mapped.close()
+    with open(target, 'w', encoding='utf-8') as doc:
+        json.dump(list(ledger), doc, ensure_ascii=False, use_decimal=True)
+    return len(ledger)
+
+
+def from_json(source, target):
+    with open(source, 'r', encoding='utf-8') as doc:
+        ledger = json.load(doc)
+    with open(target + '.tmp', 'wb') as doc:
+        doc.write(pack(ledger))
+    os.replace(target + '.tmp', target)
+    return len(ledger)
+
+
+# Writes the snapshot in the other format, binary or JSON, when the setting is changed, and
+# records it as the saved snapshot so the journal carries on from it.
+def convert_snapshot(source, target, manifest, binary=True):
+    with FileLock():
+        ledger = JournalStore(source).read_snapshot()
+        if binary:
+            data = pack(ledger)
+        else:
+            data = json.dumps(list(ledger), ensure_ascii=False, use_decimal=True).encode('utf-8')
+        stage_file(target, data)
+        committed = read_manifest(manifest)
+        if committed is not None and committed['ledger'] is not None and committed['ledger']['store'] == 'journal':
+            committed['ledger']['snapshot'] = checksum(data)
+            committed['ledger']['format'] = 'binary' if binary else 'json'
+            commit_generation(committed['ledger'], path=manifest)
+        os.replace(target + '.tmp', target)
+    logger.info("Converted %s to the %s snapshot %s (%s rows).", source, 'binary' if binary else 'JSON',
+                target, len(ledger))
+
+
+# Copies the ledger in a resources folder, journal included, and its settings into a new
+# archive folder that BaseProgram(archive=target) can open read-only.
+def make_archive(resources, target):
+    manifest = os.path.join(resources, 'manifest.json')
+    snapshot = committed_snapshot(manifest, os.path.join(resources, 'matrices.txt'),
+                                  os.path.join(resources, 'ledger.bin'))
+    if snapshot is None:  # saved before there was a manifest
+        snapshot = os.path.join(resources, 'ledger.bin')
+        if not os.path.exists(snapshot):
+            snapshot = os.path.join(resources, 'matrices.txt')
+    store = JournalStore(snapshot, os.path.join(resources, 'journal.txt'), manifest=manifest)
+    ledger = store.load()
+    os.makedirs(target, exist_ok=True)
+    with open(os.path.join(target, ARCHIVE_LEDGER) + '.tmp', 'wb') as doc:
+        doc.write(pack(ledger))
+    os.replace(os.path.join(target, ARCHIVE_LEDGER) + '.tmp', os.path.join(target, ARCHIVE_LEDGER))
+    shutil.copyfile(os.path.join(resources, 'settings.json'), os.path.join(target, ARCHIVE_SETTINGS))
+    return len(ledger)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert CFAP ledger snapshots between JSON and binary.')
+    parser.add_argument('direction', choices=('to-json', 'from-json', 'archive'))
+    parser.add_argument('source', help='snapshot file, or resources folder to archive')
+    parser.add_argument('target', help='file to write, or archive folder')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.direction == 'to-json':
+        count = to_json(args.source, args.target)
+    elif args.direction == 'archive':
+        count = make_archive(args.source, args.target)
+    else:
+        count = from_json(args.source, args.target)
+    print('{} rows written to {}.'.format(count, args.target))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,160 +7,431 @@ from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm, inch
 from reportlab.pdfbase.pdfmetrics import stringWidth as SW
 import reportlab.rl_config
+from money import to_units, from_units, exponent
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import collections
+import functools
+import os
+import sys
+import time
+import types
 
 reportlab.rl_config.warnOnMissingFontGlyphs = 0
 
+FONT = 'Arial'
+FONT_FILE = 'Arial.ttf'
+TITLE_SIZE = 18
+TEXT_SIZE = 12
+LINE = 15  # points between lines
+TOP = 700  # y of the first line under the page header
+BOTTOM = inch  # nothing is drawn below this
 
-def write_balance_sheet(church_name, funds, filepath):
 
-    # Create Page
-    canvas = Canvas(filepath, pagesize=A4)
-    width, height = A4  # keep for later
+# Loading a TrueType font is slow, so each one is registered once per process.
+@functools.lru_cache(maxsize=None)
+def register_font(name=FONT, filename=FONT_FILE):
+    pdfmetrics.registerFont(TTFont(name, filename))
+
+
+# Reports measure the same names and amounts over and over.
+@functools.lru_cache(maxsize=4096)
+def text_width(text, size=TEXT_SIZE, font=FONT):
+    return SW(text, font, size)
+
+
+# A report drawn line by line from the top of an A4 page down. When a line won't fit,
+# a new page is started with the report's title block and the current section heading
+# drawn again, so long charts of accounts carry on instead of running off the page.
+class Report:
+
+    def __init__(self, filepath, church_name, title):
+        register_font()
+        self.canvas = Canvas(filepath, pagesize=A4)
+        self.width, self.height = A4
+        self.church_name = church_name
+        self.title = title
+        self.date = pendulum.now().to_date_string()
+        self.heading = None  # (text, right-hand column label) repeated on each new page
+        self.pages = 0
+        self.y = TOP
+        self.new_page()
+
+    def new_page(self):
+        canvas = self.canvas
+        if self.pages:
+            canvas.showPage()
+        self.pages += 1
+
+        # ---- Title & Headers ---- #
+        canvas.setFont(FONT, TITLE_SIZE)
+        canvas.drawString((self.width - text_width(self.church_name, TITLE_SIZE)) / 2,
+                          self.height - inch - 20, self.church_name)
+        canvas.drawString((self.width - text_width(self.title, TITLE_SIZE)) / 2,
+                          self.height - inch - 40, self.title)
+        canvas.setFont(FONT, TEXT_SIZE)
+        canvas.drawString(inch, self.height - inch, self.date)
+        if self.pages > 1:
+            self.right(self.width - inch, str(self.pages), self.height - inch)
+
+        self.y = TOP
+        if self.heading is not None:
+            text, column = self.heading
+            self.text(inch, '{} (cont.)'.format(text))
+            if column:
+                self.text(self.width - inch * 4, column)
+            self.next()
+
+    # starts a new page unless 'lines' more lines fit on this one
+    def need(self, lines=1):
+        if self.y - LINE * (lines - 1) < BOTTOM:
+            self.new_page()
+
+    def next(self, lines=1):
+        self.y -= LINE * lines
+
+    def text(self, x, text, y=None):
+        self.canvas.drawString(x, self.y if y is None else y, text)
+
+    # text ending at x
+    def right(self, x, text, y=None):
+        self.canvas.drawString(x - text_width(text), self.y if y is None else y, text)
+
+    # a rule across the amount columns, 'offset' points above (or below) the current line
+    def rule(self, offset, width=1):
+        self.canvas.setLineWidth(width)
+        self.canvas.line(self.width - inch * 3, self.y + offset, self.width - inch, self.y + offset)
+        self.canvas.setLineWidth(1)
+
+    # a section title that is repeated at the top of every page the section runs onto
+    def section(self, text, column=None):
+        self.need(2)
+        self.heading = (text, column)
+        self.text(inch, text)
+        if column:
+            self.text(self.width - inch * 4, column)
+        self.next()
 
-    # FONT
-    pdfmetrics.registerFont(TTFont('Arial', 'Arial.ttf'))
-    canvas.setFont('Arial', 18)
+    def end_section(self):
+        self.heading = None
 
-    # ---- Title & Headers ---- #
-    header1_x = (width-SW(church_name, 'Arial', 18))/2
-    canvas.drawString(header1_x, height-inch-20, church_name)
+    def save(self):
+        self.canvas.showPage()
+        self.canvas.save()
 
-    header2_x = (width-SW('Balance Sheet Standard', 'Arial', 18))/2
-    canvas.drawString(header2_x, height-inch-40, 'Balance Sheet Standard')
 
-    date = pendulum.now().to_date_string()
-    canvas.setFont('Arial', 12)
-    canvas.drawString(inch, height-inch, date)
+# one indented fund and its amount
+def fund_line(report, indent, name, amount):
+    report.need()
+    report.text(inch + indent, name)
+    report.right(report.width - inch * 2, str(amount))
+    report.next()
+
+
+# the underlined total of a group of funds
+def total_line(report, indent, label, total):
+    report.need()
+    report.rule(13)
+    report.text(inch + indent, label)
+    report.right(report.width - inch, str(total))
+    report.next()
+
+
+def write_balance_sheet(church_name, funds, filepath):
+
+    # Create Page
+    report = Report(filepath, church_name, 'Balance Sheet Standard')
+    width = report.width
 
-    y = 700
     # ---- TOTAL ASSETS ---- #
     # Assets
-    canvas.drawString(inch, y, "ASSETS")
-    canvas.drawString(width - inch * 4, y, 'Other Currency')
-
+    report.section('ASSETS', 'Other Currency')
     total_assets = 0
-    y -= 15
+    base_exponent = exponent(funds[0][0][0][-3:])
     for asset in funds[0]:  # for each asset
         if asset[0][:4] == '1010':
-            canvas.drawString(inch + cm, y, asset[0])  # asset name
-            x = SW(str(asset[1]), 'Arial', 12)
-            canvas.drawString(width - inch * 2 - x, y, str(asset[1]))  # asset amount
+            fund_line(report, cm, asset[0], asset[1])
             total_assets += asset[1]
         else:
-            canvas.drawString(inch + cm, y, asset[0])  # asset name
-            x = SW(str(asset[1][0]), 'Arial', 12)
-            canvas.drawString(width - inch * 3.5 - x, y, str(asset[1][0]))  # asset amount (own currency)
-            y -= 15
-
-            canvas.drawString(inch + cm * 2.2, y, '{} in {}'.format(funds[0][0][0][-3:],
-                                                                    asset[0][-3:]))
-            x = SW(str(round(asset[1][1] * asset[1][0], 2)), 'Arial', 12)
-            # asset amount (in base currency)
-            canvas.drawString(width - inch * 2 - x, y, str(round(asset[1][1] * asset[1][0], 2)))
-            total_assets += round(asset[1][1] * asset[1][0], 2)
-        y -= 15
-    canvas.line(width - inch * 3, y + 13, width - inch, y + 13)  # line
-    canvas.drawString(inch+cm, y, 'Total UAH')
-    ta = SW(str(total_assets), 'Arial', 12)
-    canvas.drawString(width - inch - ta, y, str(total_assets))
-    canvas.setLineWidth(2)  # make future lines thicker
-    canvas.line(width - inch * 3, y-3, width - inch, y-3)  # line
-    y -= 30
-    canvas.setLineWidth(1)  # make future lines thinner
-    canvas.drawString(inch, y, 'TOTAL ASSETS')
-    canvas.drawString(width - inch - ta, y, str(total_assets))
-    canvas.line(width - inch * 3, y-2, width - inch, y-2)  # line
-    canvas.line(width - inch * 3, y-4, width - inch, y-4)  # line
-    y -= 30
+            report.need(2)
+            report.text(inch + cm, asset[0])  # asset name
+            report.right(width - inch * 3.5, str(asset[1][0]))  # asset amount (own currency)
+            report.next()
+            report.text(inch + cm * 2.2, '{} in {}'.format(funds[0][0][0][-3:], asset[0][-3:]))
+            # asset amount (in base currency) at the rate of its latest posting, 0 if it has none
+            rate = asset[1][1]
+            base = from_units(0 if rate is None else to_units(asset[1][0], base_exponent, rate), base_exponent)
+            report.right(width - inch * 2, str(base))
+            total_assets += base
+            report.next()
+    report.need(3)
+    report.rule(13)
+    report.text(inch + cm, 'Total UAH')
+    report.right(width - inch, str(total_assets))
+    report.rule(-3, width=2)
+    report.next(2)
+    report.end_section()
+    report.text(inch, 'TOTAL ASSETS')
+    report.right(width - inch, str(total_assets))
+    report.rule(-2)
+    report.rule(-4)
+    report.next(2)
 
     # ---- LIABILITIES AND EQUITY ----
+    report.section('LIABILITIES & EQUITY')
     # Liabilities
-    canvas.drawString(inch, y, 'LIABILITIES & EQUITY')
-    y -= 15
-    canvas.drawString(inch + cm, y, 'Liability Funds')
-    y -= 15
+    report.need(2)
+    report.text(inch + cm, 'Liability Funds')
+    report.next()
     total_liability = 0
     for liability in funds[1]:  # for each liability
-        canvas.drawString(inch + cm * 2, y, liability[0])
-        x = SW(str(liability[1]), 'Arial', 12)
-        canvas.drawString(width - inch * 2 - x, y, str(liability[1]))
-        y -= 15
+        fund_line(report, cm * 2, liability[0], liability[1])
         total_liability += liability[1]
-    canvas.line(width - inch * 3, y + 13, width - inch, y + 13)  # line
-    canvas.drawString(inch + cm, y, 'Total Liability Funds')
-    tl = SW(str(total_liability), 'Arial', 12)
-    canvas.drawString(width - inch - tl, y, str(total_liability))
-    y -= 15
+    total_line(report, cm, 'Total Liability Funds', total_liability)
 
     # Equities
-    canvas.drawString(inch + cm, y, 'Equity Funds')
-    y -= 15
+    report.need(2)
+    report.text(inch + cm, 'Equity Funds')
+    report.next()
     total_equity = 0
     for equity in funds[2]:  # for each equity
-        canvas.drawString(inch + cm * 2, y, equity[0])
-        x = SW(str(equity[1]), 'Arial', 12)
-        canvas.drawString(width - inch * 2 - x, y, str(equity[1]))
-        y -= 15
+        fund_line(report, cm * 2, equity[0], equity[1])
         total_equity += equity[1]
-    canvas.line(width - inch * 3, y + 13, width - inch, y + 13)  # line
-    canvas.drawString(inch + cm, y, 'Total Equity Funds')
-    teq = SW(str(total_equity), 'Arial', 12)
-    canvas.drawString(width - inch - teq, y, str(total_equity))
-    y -= 15
+    total_line(report, cm, 'Total Equity Funds', total_equity)
 
     # Revenues
-    canvas.drawString(inch + cm, y, 'Net Income')
-    y -= 15
-    canvas.drawString(inch + cm * 2, y, 'Revenue')
-    y -= 15
+    report.need(3)
+    report.text(inch + cm, 'Net Income')
+    report.next()
+    report.text(inch + cm * 2, 'Revenue')
+    report.next()
     total_revenue = 0
     for revenue in funds[3]:  # for each revenue
-        canvas.drawString(inch + cm * 3, y, revenue[0])
-        x = SW(str(revenue[1]), 'Arial', 12)
-        canvas.drawString(width - inch * 2 - x, y, str(revenue[1]))
-        y -= 15
+        fund_line(report, cm * 3, revenue[0], revenue[1])
         total_revenue += revenue[1]
-    canvas.line(width - inch * 3, y + 13, width - inch, y + 13)  # line
-    canvas.drawString(inch + cm * 2, y, 'Total Revenue')
-    tr = SW(str(total_revenue), 'Arial', 12)
-    canvas.drawString(width - inch - tr, y, str(total_revenue))
-    y -= 15
+    total_line(report, cm * 2, 'Total Revenue', total_revenue)
 
     # Expenses
-    canvas.drawString(inch + cm * 2, y, 'Expense')
-    y -= 15
+    report.need(2)
+    report.text(inch + cm * 2, 'Expense')
+    report.next()
     total_expense = 0
     for expense in funds[4]:  # for each expense
-        canvas.drawString(inch + cm * 3, y, expense[0])
-        x = SW(str(expense[1]), 'Arial', 12)
-        canvas.drawString(width - inch * 2 - x, y, str(expense[1]))
-        y -= 15
+        fund_line(report, cm * 3, expense[0], expense[1])
         total_expense += expense[1]
-    canvas.line(width - inch * 3, y + 13, width - inch, y + 13)  # line
-    canvas.drawString(inch + cm * 2, y, 'Total Expense')
-    te = SW(str(total_expense), 'Arial', 12)
-    canvas.drawString(width - inch - te, y, str(total_expense))
-    y -= 15
+    total_line(report, cm * 2, 'Total Expense', total_expense)
 
     # total net income
-    canvas.drawString(inch + cm, y, 'Total Net Income')
-    ne = SW(str(total_revenue + total_expense), 'Arial', 12)
-    canvas.drawString(width - inch - ne, y, str(total_expense + total_revenue))
-    canvas.setLineWidth(2)  # make future lines thicker
-    canvas.line(width - inch * 3, y-3, width - inch, y-3)  # line
-    canvas.setLineWidth(1)  # make future lines thinner
-    y -= 30
+    report.need(3)
+    report.text(inch + cm, 'Total Net Income')
+    report.right(width - inch, str(total_expense + total_revenue))
+    report.rule(-3, width=2)
+    report.next(2)
+    report.end_section()
 
     # TOTAL LIABILITIES & EQUITY
-    canvas.drawString(inch, y, 'TOTAL LIABILITIES & EQUITY')
+    report.need()
+    report.text(inch, 'TOTAL LIABILITIES & EQUITY')
     total = total_liability + total_equity + total_revenue + total_expense
-    tal = SW(str(total), 'Arial', 12)
-    canvas.drawString(width - inch - tal, y, str(total))
+    report.right(width - inch, str(total))
+    report.rule(-2)
+    report.rule(-4)
+
+    report.save()
+
+
+# 'DD/MM/YYYY' to 'DD/MM/YYYY', or an open end, under a period report's title
+def period_text(period):
+    start, end = period
+    if start is None and end is None:
+        return 'All Dates'
+    elif start is None:
+        return 'Through {}'.format(end)
+    elif end is None:
+        return 'From {}'.format(start)
+    return '{} to {}'.format(start, end)
+
+
+# data is BaseProgram.calculate_income_statement's [period, revenues, expenses]
+def write_income_statement(church_name, data, filepath):
+    period, revenues, expenses = data
+    report = Report(filepath, church_name, 'Income Statement')
+    width = report.width
+    report.text(inch, period_text(period))
+    report.next(2)
+
+    # Revenues
+    report.section('REVENUE')
+    total_revenue = 0
+    for revenue in revenues:
+        fund_line(report, cm, revenue[0], revenue[1])
+        total_revenue += revenue[1]
+    total_line(report, 0, 'Total Revenue', total_revenue)
+    report.end_section()
+    report.next()
+
+    # Expenses
+    report.section('EXPENSE')
+    total_expense = 0
+    for expense in expenses:
+        fund_line(report, cm, expense[0], expense[1])
+        total_expense += expense[1]
+    total_line(report, 0, 'Total Expense', total_expense)
+    report.end_section()
+    report.next()
+
+    # NET INCOME
+    report.need()
+    report.text(inch, 'NET INCOME')
+    report.right(width - inch, str(total_revenue - total_expense))
+    report.rule(-2)
+    report.rule(-4)
+
+    report.save()
+
+
+# data is BaseProgram.calculate_fund_statements' [period, [(fund, opening, rows, closing)]],
+# one section per fund listing its rows with a running balance
+def write_fund_statements(church_name, data, filepath):
+    period, statements = data
+    report = Report(filepath, church_name, 'Fund Statements')
+    width = report.width
+    report.text(inch, period_text(period))
+    report.next(2)
+    memo_width = width - inch * 5.5 - cm  # between the transaction number and the amounts
+
+    for fund, opening, rows, closing in statements:
+        report.section(fund)
+        fund_line(report, cm, 'Opening Balance', opening)
+        for trans, date, memo, amount, balance in rows:
+            memo = memo or ''
+            while memo and text_width(memo) > memo_width:
+                memo = memo[:-1]
+            report.need()
+            report.text(inch + cm, date)
+            report.right(inch * 3, str(trans))
+            report.text(inch * 3 + cm / 2, memo)
+            report.right(width - inch * 2, str(amount))
+            report.right(width - inch, str(balance))
+            report.next()
+        total_line(report, cm, 'Closing Balance', closing)
+        report.end_section()
+        report.next()
+
+    report.save()
+
+
+# ---- Running many reports at once ---- #
+
+# one report to draw: church name, report type (a key of REPORTS), period and output file.
+# period is a 'DD/MM/YYYY' date, or None for the ledger as it is now, for the balance sheet
+# and a (start, end) pair of those for the income statement and fund statements
+ReportJob = collections.namedtuple('ReportJob', 'church report period filepath')
+
+# report type -> writer(church_name, data, filepath). Writers added with register_report must be
+# registered when their module is imported, so worker processes started fresh know them too.
+REPORTS = {'balance_sheet': write_balance_sheet,
+           'income_statement': write_income_statement,
+           'fund_statements': write_fund_statements}
+
+_snapshot = None  # the worker's copy of the report data
+
+
+def register_report(name, writer):
+    REPORTS[name] = writer
+
+
+# runs once in each worker: keep a read-only copy of the data and load the fonts
+def start_worker(snapshot):
+    global _snapshot
+    _snapshot = types.MappingProxyType(snapshot)
+    register_font()
+
+
+# draws one report in a worker and returns how long it took
+def render_job(job):
+    started = time.perf_counter()
+    REPORTS[job.report](job.church, _snapshot[job.church, job.report, job.period], job.filepath)
+    return time.perf_counter() - started
+
+
+# Draws every job in a pool of processes, since ReportLab is CPU-bound and can't share the GIL.
+# snapshot maps (church, report, period) to the data the report's writer takes, e.g. from
+# BaseProgram.report_snapshot. progress(done, total, job, seconds, error) is called as each
+# job finishes. Returns [(job, seconds, error)] in the order the jobs finished.
+def run_reports(jobs, snapshot, workers=None, progress=None):
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker, initargs=(snapshot,)) as pool:
+        futures = {pool.submit(render_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                seconds, error = future.result(), None
+            except Exception as exc:
+                seconds, error = None, exc
+            results.append((job, seconds, error))
+            if progress is not None:
+                progress(len(results), len(jobs), job, seconds, error)
+    return results
+
+
+# 'balance_sheet' -> '2026-10-17 Balance Sheet.pdf' in folder
+def report_file(folder, report):
+    return os.path.join(folder, '{} {}.pdf'.format(pendulum.now().to_date_string(), report.replace('_', ' ').title()))
+
+
+# draws the reports asked for from the ledger in resources/, e.g.
+#   python buildreports.py --from 01/01/2020 --to 31/12/2020 --folder reports
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Draw CFAP reports as PDF files, several at once.')
+    parser.add_argument('reports', nargs='*', metavar='report',
+                        help='any of {} (default: all of them)'.format(', '.join(sorted(REPORTS))))
+    parser.add_argument('--as-of', dest='as_of', metavar='DD/MM/YYYY',
+                        help='date of the balance sheet (default: the ledger as it is now)')
+    parser.add_argument('--from', dest='start', metavar='DD/MM/YYYY',
+                        help='first date of the income statement and fund statements (default: the first posting)')
+    parser.add_argument('--to', dest='end', metavar='DD/MM/YYYY',
+                        help='last date of the income statement and fund statements (default: the last posting)')
+    parser.add_argument('--folder', default='.', help='where the PDF files go (default: here)')
+    parser.add_argument('--workers', type=int, help='processes drawing at once (default: one per CPU)')
+    args = parser.parse_args(argv)
+    for report in args.reports:
+        if report not in REPORTS:
+            parser.error('no report called {!r}'.format(report))
+
+    from backend import BaseProgram, validate_date
+    from errors import LedgerError
+    try:
+        for date in (args.as_of, args.start, args.end):
+            if date is not None:
+                validate_date(date)
+    except LedgerError as error:
+        print(error, file=sys.stderr)
+        return 2
+    program = BaseProgram()
+    snapshot = {}
+    jobs = []
+    church = program.settings['Church Name']
+    try:
+        for report in dict.fromkeys(args.reports or sorted(REPORTS)):
+            period = args.as_of if report == 'balance_sheet' else (args.start, args.end)
+            snapshot.update(program.report_snapshot([report], [period]))
+            jobs.append(ReportJob(church, report, period, report_file(args.folder, report)))
+    except LedgerError as error:
+        print(error, file=sys.stderr)
+        return 1
+
+    def progress(done, total, job, seconds, error):
+        if error is None:
+            print('[{}/{}] {} ({:.1f}s)'.format(done, total, job.filepath, seconds))
+        else:
+            print('[{}/{}] {} failed: {}'.format(done, total, job.filepath, error), file=sys.stderr)
+
+    results = run_reports(jobs, snapshot, args.workers, progress)
+    return 1 if any(error is not None for job, seconds, error in results) else 0
 
-    canvas.line(width - inch * 3, y - 2, width - inch, y - 2)  # line
-    canvas.line(width - inch * 3, y - 4, width - inch, y - 4)  # line
 
-    canvas.showPage()
-    canvas.save()
+if __name__ == '__main__':
+    sys.exit(main())
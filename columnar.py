@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+from storage import date_ordinal, to_text
+from money import to_units, from_units
+from array import array
+import datetime
+import decimal
+
+D = decimal.Decimal
+
+
+# Interns strings: each distinct value is stored once and rows hold its number.
+class StringTable:
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def intern(self, text):
+        if text is None:
+            return -1
+        try:
+            return self.ids[text]
+        except KeyError:
+            self.ids[text] = len(self.strings)
+            self.strings.append(text)
+            return self.ids[text]
+
+    def get(self, number):
+        if number < 0:
+            return None
+        return self.strings[number]
+
+
+# A drop-in replacement for the list of 9-element ledger rows that keeps every field in a
+# typed array instead of a Python list of Decimals and strings:
+#   trans# -> int64, date -> ordinal (int32), account/memo/payee -> interned string ids,
+#   base/debit/credit -> cents (int64), exrate -> interned decimal string id
+# Indexing, slicing, iterating and append() hand out and take ordinary rows,
+# so load_fund, fund_page and the stores don't know the difference.
+class ColumnarLedger:
+
+    def __init__(self, rows=()):
+        self.trans = array('q')
+        self.dates = array('i')
+        self.accounts = array('i')
+        self.base = array('q')
+        self.debit = array('q')
+        self.credit = array('q')
+        self.exrates = array('i')
+        self.memos = array('i')
+        self.payees = array('i')
+        self.strings = StringTable()
+        self.odd_dates = {}  # position -> date text that isn't a valid DD/MM/YYYY date
+        self.extend(rows)
+
+    def __len__(self):
+        return len(self.trans)
+
+    def __iter__(self):
+        for position in range(len(self.trans)):
+            yield self.row(position)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.row(position) for position in range(*item.indices(len(self.trans)))]
+        if item < 0:
+            item += len(self.trans)
+        if not 0 <= item < len(self.trans):
+            raise IndexError('ledger index out of range')
+        return self.row(item)
+
+    def append(self, row):
+        position = len(self.trans)
+        self.trans.append(int(row[0]))
+        ordinal = date_ordinal(row[1])
+        if ordinal is None:
+            self.odd_dates[position] = row[1]
+            ordinal = -1
+        self.dates.append(ordinal)
+        self.accounts.append(self.strings.intern(row[2]))
+        self.base.append(to_units(row[3]))
+        self.debit.append(to_units(row[4]))
+        self.credit.append(to_units(row[5]))
+        if row[6] is None:
+            self.exrates.append(-1)
+        else:
+            self.exrates.append(self.strings.intern(to_text(row[6])))
+        self.memos.append(self.strings.intern(row[7]))
+        self.payees.append(self.strings.intern(row[8]))
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    # rebuilds the [trans#, date, account, base, debit, credit, exrate, memo, payee] row
+    def row(self, position):
+        ordinal = self.dates[position]
+        if ordinal < 0:
+            date = self.odd_dates[position]
+        else:
+            date = datetime.date.fromordinal(ordinal).strftime('%d/%m/%Y')
+        exrate = self.exrates[position]
+        return [self.trans[position],
+                date,
+                self.strings.get(self.accounts[position]),
+                from_units(self.base[position]),
+                from_units(self.debit[position]),
+                from_units(self.credit[position]),
+                None if exrate < 0 else D(self.strings.get(exrate)),
+                self.strings.get(self.memos[position]),
+                self.strings.get(self.payees[position])]
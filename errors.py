@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+# Errors raised by the ledger engine. The backend never opens a window itself:
+# frontend.py catches these and shows them in a message box, while batch jobs
+# and the server report them however suits them. Messages are already translated.
+
+
+class LedgerError(Exception):
+    title = 'Error'  # message box title, translated by the frontend
+
+
+# an account number that is unknown, or already taken when adding a fund
+class AccountError(LedgerError):
+    pass
+
+
+class DateError(LedgerError):
+    title = 'Date Error'
+
+
+# a transaction the ledger can't record in the shape it was given
+class TransactionError(LedgerError):
+    title = 'Inappropriate Transaction'
+
+
+# Not enough money in a fund, or at an alternate currency's exchange rate.
+# fund and exrate say where; exrate is set when the rate has no record at all.
+class InsufficientFundsError(LedgerError):
+    title = 'Insufficient Funds'
+
+    def __init__(self, message, fund=None, exrate=None):
+        super().__init__(message)
+        self.fund = fund
+        self.exrate = exrate
+
+
+# another program saved rows that can't be combined with the ones here
+class ConflictError(LedgerError):
+    title = 'Save Conflict'
+
+
+# a change asked of a ledger opened read-only, e.g. an archive
+class ReadOnlyError(LedgerError):
+    title = 'Read Only'
@@ -3,25 +3,34 @@
 import tkinter as tk
 from tkinter import ttk, filedialog
 from mbox import mbox
-from backend import BaseProgram, check_date, exception_hook, upload_ledger, get_language
-from buildreports import write_balance_sheet
+from backend import BaseProgram, validate_date, exception_hook, upload_ledger, get_language
+from errors import LedgerError, DateError, InsufficientFundsError
+from buildreports import write_balance_sheet, write_income_statement, write_fund_statements
+from storage import date_ordinal
+from autosave import Autosaver, INTERVAL, POSTINGS
 from calculator import Calculator
 import simplejson as json
+import argparse
 import datetime
 import decimal
 import gettext
 import logging
 import logging.config
 import os
+import queue
 import sys
+import threading
 
 get_language()
 
+PAGE_BATCH_SIZE = 500  # rows handed from the worker to the Treeview at a time
+PAGE_FILL_DELAY = 20  # ms between checks for new rows
+
 
 class UserInterface(BaseProgram):
 
-    def __init__(self, master):
-        super().__init__()
+    def __init__(self, master, archive=None):
+        super().__init__(archive)
 
         # Logging
         self.logger = logging.getLogger(__name__)
@@ -250,6 +259,11 @@ class UserInterface(BaseProgram):
         self.expense_button.pack(side='left', fill='both', expand='yes')
         self.transfer_button.pack(side='left', fill='both', expand='yes')
         self.exchange_button.pack(side='left', fill='both', expand='yes')
+        # an archive is only for looking at
+        if self.read_only:
+            for button in (self.offering_button, self.income_button, self.expense_button,
+                           self.transfer_button, self.exchange_button):
+                button.config(state='disabled')
 
         # --- populate self.page ---
         # create title
@@ -267,7 +281,6 @@ class UserInterface(BaseProgram):
         search_tree_entry = ttk.Entry(search_frame, width=20, textvariable=self._toSearch, font=(self.FONT, self.SIZE))
         search_tree_entry.pack(side='left')
 
-        search_tree_entry.config(state='disabled')  # search ability not yet usable
         self._toSearch.trace_variable('w', lambda x, y, z: self.search_treeview())
 
         # Create Label for Right Clicking Notice
@@ -279,15 +292,42 @@ class UserInterface(BaseProgram):
         self.save_label = ttk.Label(frame, text="Last Saved:           ", style="color.TLabel")
         self.save_label.grid(column=3, row=2, sticky='e')
 
+        self.setup_fund_tree(self.page)
+
         self.populate_fund_menu_directory(self.menu_directory_frame)
 
         self.settings_checker = self.settings
 
         self.my_funds = self.get_funds()
 
+        if not self.ledger_ready.is_set():
+            self.master.after(100, self.watch_ledger_load)
+
+        # saves in the background as entries are made (see autosave.py)
+        self.autosaver = Autosaver(self, self.master.after,
+                                   interval=self.settings.get('autosave_seconds', INTERVAL),
+                                   postings=self.settings.get('autosave_postings', POSTINGS),
+                                   saved=self.show_saved, failed=self.show_save_failed)
+        self.autosaver.start()
+        self.master.protocol('WM_DELETE_WINDOW', self.on_exit)
+
         self.master.update_idletasks()
         print("frontend load successful")
 
+    # The window opens with the saved summary while the full ledger loads in the background.
+    # Once it is in, redraw the General Ledger and fund totals from the real data.
+    def watch_ledger_load(self):
+        if self.ledger_ready.is_set():
+            if self.load_error is not None:
+                mbox(_('Error'), _('The ledger could not be loaded:\n{}').format(self.load_error),
+                     b1=_('Ok'), b2=None)
+                return
+            if self.page_title.cget('text') == _("General Ledger"):
+                self.fund_page(self.page, _("General Ledger"), self.ledger)
+            self.populate_directory_amounts()
+        else:
+            self.master.after(100, self.watch_ledger_load)
+
     # Creates the menu options located at the top of the screen (Mac)
     # or top of the window (Windows)
     def setup_menubar(self, frame):
@@ -340,6 +380,10 @@ class UserInterface(BaseProgram):
         self.report_menu = tk.Menu(self.menubar)
         self.report_menu.add_command(label=_('Generate a Report'), command=placeholder, state="disable")
         self.report_menu.add_command(label=_('Generate Balance Sheet'), command=self.generate_balance_report)
+        self.report_menu.add_command(label=_('Generate Income Statement'),
+                                     command=lambda: self.set_report_window('income_statement'))
+        self.report_menu.add_command(label=_('Generate Fund Statements'),
+                                     command=lambda: self.set_report_window('fund_statements'))
         self.menubar.add_cascade(label=_('Reports'), menu=self.report_menu)
 
         self.helpmenu = tk.Menu(self.menubar)
@@ -350,6 +394,12 @@ class UserInterface(BaseProgram):
 
         # Disabled menu items (because they are placeholders at the moment)
         self.report_menu.entryconfig(0, state='disabled')
+        # nothing that changes the ledger or settings while an archive is open
+        if self.read_only:
+            self.file_menu.entryconfig(0, state='disabled')
+            for item in range(4):
+                self.edit_menu.entryconfig(item, state='disabled')
+            self.menubar.entryconfig(_('Transactions'), state='disabled')
 
     # Populates the 'Menu' of Frames located to the left of the window
     def populate_fund_menu_directory(self, frame):
@@ -362,7 +412,7 @@ class UserInterface(BaseProgram):
 
         # Button widgets
         gl_button = ttk.Button(frame, text=_("General Ledger"), style="color.TButton",
-                               command=lambda: self.fund_page(self.page, _("General Ledger"), self.ledger))
+                               command=lambda: self.fund_page(self.page, _("General Ledger"), self.general_ledger()))
         gl_button.grid(column=0, row=1, sticky='nswe')
 
         directory_buttons = list()
@@ -374,12 +424,41 @@ class UserInterface(BaseProgram):
                                                 style="color.TButton",
                                                 command=lambda x=x: self.fund_page(self.page,
                                                                                    fundnames[funds.index(x)],
-                                                                                   self.load_fund(x))))
+                                                                                   lambda: self.load_fund(x))))
             directory_buttons[-1].grid(column=0, row=i+2, sticky='nswe')
 
         self.populate_directory_amounts()
 
-        self.fund_page(self.page, _("General Ledger"), self.ledger)
+        self.fund_page(self.page, _("General Ledger"), self.general_ledger())
+
+    # Builds the one Treeview that every fund page is shown in. Only the rows that fit in the
+    # widget are ever inserted; scrolling swaps them for the next rows of self.page_rows.
+    def setup_fund_tree(self, frame):
+        self.tree = ttk.Treeview(frame, height=20)
+        self.tree.grid(column=0, row=1, sticky="NSEW", columnspan=10)
+
+        self.scrollbar = ttk.Scrollbar(frame, command=self.scroll_fund_page)
+        self.scrollbar.grid(column=11, row=1, sticky='NSE')
+
+        self.page_rows = []  # every row of the page, already in display order
+        self.page_source = []  # the same rows in ledger order
+        self.page_sorts = {}  # {column: row indices of page_source in sorted order}
+        self.page_filter = None  # transaction numbers matching the search box, if anything is typed
+        self.page_top = 0  # index in self.page_rows of the first row shown
+        self.page_generation = 0  # bumped for every page opened; stale workers stop when it changes
+        self.page_loading = False
+
+        self.page_progress = ttk.Progressbar(frame, orient='horizontal', mode='determinate', length=150)
+        self.page_progress.grid(column=9, row=2, sticky='e', columnspan=2)
+        self.page_progress.grid_remove()
+
+        self.tree.tag_configure('oddrow', background=self.secondary)
+
+        self.tree.bind("<Double-1>", lambda e: self._on_doubleclick(e))
+        self.tree.bind("<Button-2>", lambda e: self._on_right_click(e))
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll_fund_page('scroll', -1 if e.delta > 0 else 1, 'units'))
+        self.tree.bind("<Button-4>", lambda e: self.scroll_fund_page('scroll', -1, 'units'))
+        self.tree.bind("<Button-5>", lambda e: self.scroll_fund_page('scroll', 1, 'units'))
 
     # This creates information that is displayed for each fund
     #  Displaying as Follows:
@@ -387,23 +466,15 @@ class UserInterface(BaseProgram):
     #  Alt. Currency - Trans. #, Date, Amount, Exchange Rate, Loc. Balance, Base Value, Base Balance, Memo, Name
     #  Other fund - Trans. #, Date, Amount, Balance, Memo, Payee
     def fund_page(self, frame, title, data):
-        self.tree = ttk.Treeview(frame, height=20)
-        self.tree.grid(column=0, row=1, sticky="NSEW", columnspan=10)
-
-        self.scrollbar = ttk.Scrollbar(frame, command=self.tree.yview)
-        self.scrollbar.grid(column=11, row=1, sticky='NSE')
-        self.tree.config(yscrollcommand=self.scrollbar.set)
-
         alternate_currencies = []
         for x in self.settings['accounts']['assets']:
             if x != '1010':
                 alternate_currencies.append(self.settings['accounts']['assets'][x][0])
 
+        self.page_title.config(text=title)
+
         # ---- if GENERAL LEDGER is selected ---- #
         if title == _("General Ledger"):
-            self.page_title.config(text=title)
-
-            self.tree.delete(*self.tree.get_children())
             self.tree.config(columns=('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H'))
             self.tree.heading('#0', text=_('#'), command=lambda: self.fund_page(frame, title, data))
             self.tree.heading('#1', text=_('Date'), command=lambda: self.sort_date_column(self.tree, '#1', False))
@@ -423,28 +494,10 @@ class UserInterface(BaseProgram):
             self.tree.column('#6', stretch=False, width=45, anchor='e')
             self.tree.column('#7', stretch=False, width=150, anchor='w')
             self.tree.column('#8', stretch=False, width=90, anchor='w')
-            for entry in data:
-                a = list()
-                a.append(entry[0])  # add transaction date because
-                for x in entry[1:]:  # don't change transaction number
-                    if x == D('0'):
-                        a.append('')
-                    elif x is None:
-                        a.append('')
-                    else:
-                        a.append(x)
-                if len(self.tree.get_children('')) % 2 == 0:
-                    self.tree.insert('', 'end', text=a[0], tags='evenrow',
-                                     values=(a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8]))
-                else:
-                    self.tree.insert('', 'end', text=a[0], tags='oddrow',
-                                     values=(a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8]))
+            kind = 'general'
 
         # ---- if an ALTERNATE CURRENCY ---- #
         elif title in alternate_currencies:
-            self.page_title.config(text=title)
-
-            self.tree.delete(*self.tree.get_children())
             self.tree.config(columns=('A', 'B', 'C', 'D', 'E', 'F', 'G', 'I'))
             self.tree.heading('#0', text=_('#'), command=lambda: self.fund_page(frame, title, data))
             self.tree.heading('#1', text=_('Date'), command=lambda: self.sort_date_column(self.tree, '#1', False))
@@ -464,75 +517,203 @@ class UserInterface(BaseProgram):
             self.tree.column('#6', stretch=False, width=100, anchor='e')
             self.tree.column('#7', stretch=False, width=125, anchor='w')
             self.tree.column('#8', stretch=False, width=95, anchor='w')
-
-            base_amount = D('0.00')
-            for entry in data:
-                a = list()
-                a.append(entry[0])  # add transaction number because we don't want to change it at all
-                for x in entry[1:]:  # any 0s or None statements should show up blank
-                    if x != entry[4]:
-                        if x == D('0'):
-                            a.append('')
-                        elif x is None:
-                            a.append('')
-                        else:
-                            a.append(x)
-                    else:  # don't change 'amount'
-                        a.append(x)
-                amount = (a[2] * a[3]).quantize(self.cents, decimal.ROUND_HALF_UP)
-                base_amount += amount
-                if len(self.tree.get_children('')) % 2 == 0:
-                    self.tree.insert('', 'end', text=a[0], tags='evenrow',
-                                     values=(a[1], a[2], a[3], a[4], amount, base_amount, a[5], a[6]))
-                else:
-                    self.tree.insert('', 'end', text=a[0], tags='oddrow',
-                                     values=(a[1], a[2], a[3], a[4], amount, base_amount, a[5], a[6]))
+            kind = 'alternate'
         #
         # ---- all OTHER FUNDS ----- #
         #
         else:
-            self.page_title.config(text=title)
-
-            self.tree.delete(*self.tree.get_children())
             self.tree.config(columns=('A', 'B', 'C', 'D', 'E'))
             self.tree.heading('#0', text=_('#'), command=lambda: self.fund_page(frame, title, data))
             self.tree.heading('#1', text=_('Date'), command=lambda: self.sort_date_column(self.tree, '#1', False))
             self.tree.heading('#2', text=_('Amount'), command=lambda: self.sort_column(self.tree, '#2', False))
-            self.tree.heading('#3', text=_('Balance'), command=lambda: self.sort_column(self.tree, '#4', False))
-            self.tree.heading('#4', text=_('Memo'), command=lambda: self.sort_column(self.tree, '#5', False))
-            self.tree.heading('#5', text=_('Payee'), command=lambda: self.sort_column(self.tree, '#6', False))
+            self.tree.heading('#3', text=_('Balance'), command=lambda: self.sort_column(self.tree, '#3', False))
+            self.tree.heading('#4', text=_('Memo'), command=lambda: self.sort_column(self.tree, '#4', False))
+            self.tree.heading('#5', text=_('Payee'), command=lambda: self.sort_column(self.tree, '#5', False))
             self.tree.column('#0', stretch=False, width=60, anchor='w')
             self.tree.column('#1', stretch=False, width=95, anchor='w')
             self.tree.column('#2', stretch=False, width=120, anchor='e')
             self.tree.column('#3', stretch=False, width=120, anchor='e')
             self.tree.column('#4', stretch=False, width=245, anchor='w')
             self.tree.column('#5', stretch=False, width=170, anchor='w')
-            for entry in data:
-                a = list()
-                a.append(entry[0])  # add transaction number because we
-                for x in entry[1:]:  # don't change transaction number
-                    if x == D('0'):
-                        a.append('')
-                    elif x is None:
-                        a.append('')
-                    else:
-                        a.append(x)
-                if a[4] == '':
-                    a[4] = D('0').quantize(self.cents, decimal.ROUND_HALF_UP)
-                if len(self.tree.get_children('')) % 2 == 0:
-                    self.tree.insert('', 'end', text=a[0], tags='evenrow',
-                                     values=(a[1], a[2], a[4], a[5], a[6]))
+            kind = 'fund'
+
+        self.start_page_fill(kind, data)
+
+    # Rows are tallied and formatted on a worker thread and handed to the Treeview in batches,
+    # so a big fund doesn't freeze the window. Opening another page cancels the one in progress.
+    # data is a list of rows, or a function returning one (e.g. lambda: self.load_fund('3000'))
+    def start_page_fill(self, kind, data):
+        self.page_generation += 1
+        self.page_rows = self.page_source = []
+        self.page_sorts = {}
+        self.page_filter = None
+        self._toSearch.set('')
+        self.page_top = 0
+        self.page_loading = True
+        self.render_fund_page()
+
+        self.page_progress.configure(value=0)
+        self.page_progress.grid()
+
+        generation = self.page_generation
+        rows_queue = queue.Queue()
+        threading.Thread(target=self.prepare_page_rows, daemon=True,
+                         args=(generation, kind, data, rows_queue)).start()
+        self.master.after(PAGE_FILL_DELAY, lambda: self.fill_fund_page(generation, rows_queue))
+
+    # worker thread: formats the rows and queues them as (batch, rows done, total rows).
+    # No message boxes off the Tk thread: anything that goes wrong is queued for fill_fund_page.
+    def prepare_page_rows(self, generation, kind, data, rows_queue):
+        try:
+            self.queue_page_rows(generation, kind, data, rows_queue)
+        except Exception as error:
+            self.logger.exception("Could not load the page.")
+            rows_queue.put(error)
+
+    def queue_page_rows(self, generation, kind, data, rows_queue):
+        if callable(data):
+            data = data()
+        total = len(data)
+        batch = []
+        base_amount = D('0.00')
+        for count, entry in enumerate(data, 1):
+            if generation != self.page_generation:  # the user went to another page
+                return
+            if kind == 'general':
+                batch.append(self.general_ledger_row(entry))
+            elif kind == 'alternate':
+                batch.append(self.alternate_currency_row(entry, base_amount))
+                base_amount = batch[-1][1][5]
+            else:
+                batch.append(self.fund_row(entry))
+            if len(batch) == PAGE_BATCH_SIZE:
+                rows_queue.put((batch, count, total))
+                batch = []
+        rows_queue.put((batch, total, total))
+
+    # main thread: moves queued rows into the page until the worker is finished
+    def fill_fund_page(self, generation, rows_queue):
+        if generation != self.page_generation:
+            return
+        shown = len(self.page_rows)
+        done = False
+        while not rows_queue.empty():
+            item = rows_queue.get_nowait()
+            if isinstance(item, Exception):
+                # keep what was shown so far, and say why the rest is missing
+                self.page_loading = False
+                self.page_progress.grid_remove()
+                self.render_fund_page()
+                if isinstance(item, LedgerError):
+                    show_error(item)
+                else:
+                    mbox(_('Error'), _('The page could not be loaded:\n{}').format(item), b1=_('Ok'), b2=None)
+                return
+            batch, count, total = item
+            self.page_source.extend(batch)
+            if self.page_rows is not self.page_source:  # a search is narrowing the page
+                self.page_rows.extend(row for row in batch if row[0] in self.page_filter)
+            self.page_progress.configure(value=100 * count / total if total else 100)
+            done = count == total
+
+        # only touch the widget if the new rows land in the visible window
+        if shown < self.page_top + int(self.tree.cget('height')) and len(self.page_rows) > shown:
+            self.render_fund_page()
+        elif self.page_rows:
+            self.render_fund_page_scrollbar()
+
+        if done:
+            self.page_loading = False
+            self.page_progress.grid_remove()
+        else:
+            self.master.after(PAGE_FILL_DELAY, lambda: self.fill_fund_page(generation, rows_queue))
+
+    # (text, values) of a General Ledger row
+    def general_ledger_row(self, entry):
+        a = list()
+        a.append(entry[0])  # add transaction date because
+        for x in entry[1:]:  # don't change transaction number
+            if x == D('0'):
+                a.append('')
+            elif x is None:
+                a.append('')
+            else:
+                a.append(x)
+        return a[0], (a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8])
+
+    # (text, values) of an alternate currency row, given the base balance before it
+    def alternate_currency_row(self, entry, base_amount):
+        a = list()
+        a.append(entry[0])  # add transaction number because we don't want to change it at all
+        for x in entry[1:]:  # any 0s or None statements should show up blank
+            if x != entry[4]:
+                if x == D('0'):
+                    a.append('')
+                elif x is None:
+                    a.append('')
                 else:
-                    self.tree.insert('', 'end', text=a[0], tags='oddrow',
-                                     values=(a[1], a[2], a[4], a[5], a[6]))
+                    a.append(x)
+            else:  # don't change 'amount'
+                a.append(x)
+        amount = (a[2] * a[3]).quantize(self.cents, decimal.ROUND_HALF_UP)
+        base_amount += amount
+        return a[0], (a[1], a[2], a[3], a[4], amount, base_amount, a[5], a[6])
+
+    # (text, values) of any other fund's row
+    def fund_row(self, entry):
+        a = list()
+        a.append(entry[0])  # add transaction number because we
+        for x in entry[1:]:  # don't change transaction number
+            if x == D('0'):
+                a.append('')
+            elif x is None:
+                a.append('')
+            else:
+                a.append(x)
+        if a[4] == '':
+            a[4] = D('0').quantize(self.cents, decimal.ROUND_HALF_UP)
+        return a[0], (a[1], a[2], a[4], a[5], a[6])
+
+    # Puts the rows from self.page_top onwards into the Treeview, as many as it has room for.
+    # Striping comes from the row's index so it stays the same however far you scroll.
+    def render_fund_page(self):
+        height = int(self.tree.cget('height'))
+        self.page_top = max(0, min(self.page_top, len(self.page_rows) - height))
+
+        self.tree.delete(*self.tree.get_children())
+        for index in range(self.page_top, min(self.page_top + height, len(self.page_rows))):
+            text, values = self.page_rows[index]
+            if index % 2 == 0:
+                self.tree.insert('', 'end', text=text, tags='evenrow', values=values)
+            else:
+                self.tree.insert('', 'end', text=text, tags='oddrow', values=values)
 
-        self.tree.tag_configure('oddrow', background=self.secondary)
+        self.render_fund_page_scrollbar()
 
-        self.tree.bind("<Double-1>", lambda e: self._on_doubleclick(e))
-        self.tree.bind("<Button-2>", lambda e: self._on_right_click(e))
+    def render_fund_page_scrollbar(self):
+        height = int(self.tree.cget('height'))
+        if self.page_rows:
+            self.scrollbar.set(self.page_top / len(self.page_rows),
+                               min(1, (self.page_top + height) / len(self.page_rows)))
+        else:
+            self.scrollbar.set(0, 1)
+
+    # Scrollbar and mouse wheel commands: ('moveto', fraction) or ('scroll', n, 'units'/'pages')
+    def scroll_fund_page(self, *args):
+        height = int(self.tree.cget('height'))
+        if args[0] == 'moveto':
+            self.page_top = int(float(args[1]) * len(self.page_rows))
+        elif args[0] == 'scroll':
+            if args[2] == 'pages':
+                self.page_top += int(args[1]) * height
+            else:
+                self.page_top += int(args[1])
+        self.render_fund_page()
 
     # Populates the widgets for the window to give an offering
     def set_offering_window(self):
+        if not self.writable():
+            return
         if self.win_window_open is True:
             mbox(_('Window Open'),
                  _('You need to close a transaction window before beginning another.'),
@@ -597,6 +778,8 @@ class UserInterface(BaseProgram):
 
     # Populates the widgets to make a general transaction
     def setup_transaction_window(self, transaction):
+        if not self.writable():
+            return
         if self.win_window_open is True:
             mbox(_('Window Open'),
                  _('You need to close a transaction window before beginning another.'),
@@ -859,7 +1042,11 @@ class UserInterface(BaseProgram):
                     if len(debit_amounts) == 1:
                         debit_amounts = debit_amounts[0]
                     if len(debit_amounts) > 0:
-                        self.add_offering(date, debit_funds, debit_amounts, self.memo_input.get())
+                        try:
+                            self.add_offering(date, debit_funds, debit_amounts, self.memo_input.get())
+                        except LedgerError as error:
+                            show_error(error)
+                            return
                         self.win.destroy()
                         self.win_window_open = False
                         self.fund_page(self.page, _("General Ledger"), self.ledger)
@@ -903,8 +1090,7 @@ class UserInterface(BaseProgram):
                                 if x[5].get() != '':
                                     # check to see if available
                                     currency_name = self.credits[self.input_credit_amounts.index(x)]
-                                    if self.subtract_from_alt_currency_records(currency_name,
-                                                                               x[2].get(), x[5].get()):
+                                    if self.withdraw_alt_currency(currency_name, x[2].get(), x[5].get()):
                                         # record debit total
                                         c += D(x[2].get()) * D(x[5].get())
                                         # alt.currency is recorded as a tuple (amount, exrate)
@@ -941,21 +1127,25 @@ class UserInterface(BaseProgram):
                             debit_amounts = debit_amounts[0]
                         if len(credit_amounts) == 1:
                             credit_amounts = credit_amounts[0]
-                        if trans_type == 'income':
-                            self.add_income(date, debit_funds, credit_funds, debit_amounts, credit_amounts,
-                                            self.memo_input.get(), self.payee_input.get())
-                        elif trans_type == 'expense':
-                            if self.enough_funds(credit_funds, credit_amounts):  # if there is enough
-                                self.add_expense(date, debit_funds, credit_funds, debit_amounts, credit_amounts,
-                                                 self.memo_input.get(), self.payee_input.get())
-                        elif trans_type == 'transfer':
-                            if self.enough_funds(debit_funds, debit_amounts):  # if there is enough
-                                self.add_transfer(date, debit_funds, credit_funds, debit_amounts, credit_amounts,
-                                                  self.memo_input.get())
-                        elif trans_type == 'exchange':
-                            if self.enough_funds(credit_funds, credit_amounts):  # if there is enough
-                                self.add_exchange(date, debit_funds, credit_funds, debit_amounts, credit_amounts,
-                                                  self.memo_input.get())
+                        try:
+                            if trans_type == 'income':
+                                self.add_income(date, debit_funds, credit_funds, debit_amounts, credit_amounts,
+                                                self.memo_input.get(), self.payee_input.get())
+                            elif trans_type == 'expense':
+                                if self.enough_funds(credit_funds, credit_amounts):  # if there is enough
+                                    self.add_expense(date, debit_funds, credit_funds, debit_amounts,
+                                                     credit_amounts, self.memo_input.get(), self.payee_input.get())
+                            elif trans_type == 'transfer':
+                                if self.enough_funds(debit_funds, debit_amounts):  # if there is enough
+                                    self.add_transfer(date, debit_funds, credit_funds, debit_amounts,
+                                                      credit_amounts, self.memo_input.get())
+                            elif trans_type == 'exchange':
+                                if self.enough_funds(credit_funds, credit_amounts):  # if there is enough
+                                    self.add_exchange(date, debit_funds, credit_funds, debit_amounts,
+                                                      credit_amounts, self.memo_input.get())
+                        except LedgerError as error:
+                            show_error(error)
+                            return
                         # when all said and done
                         if self.payee_input.get() not in self.payee_names and len(self.payee_input.get()) > 0:
                             self.payee_names.append(self.payee_input.get())
@@ -989,6 +1179,31 @@ class UserInterface(BaseProgram):
                     self.date_input.set(datestr)
             return
 
+    # asks before taking more of an alternate currency than is recorded at that rate
+    def withdraw_alt_currency(self, fund, amount, exrate):
+        try:
+            return self.subtract_from_alt_currency_records(fund, amount, exrate)
+        except InsufficientFundsError as error:
+            if error.exrate is not None:
+                question = _('There is no exchange rate for {}.'
+                             '\nWould you like to continue anyway?').format(error.exrate)
+            else:
+                question = _('There is not enough in the {} account for that rate.'
+                             '\nWould you like to continue anyway?').format(error.fund)
+            if mbox(_('Insufficient Funds'), question, b1=_('Yes'), b2=_('No')):
+                return self.subtract_from_alt_currency_records(fund, amount, exrate, force=True)
+            else:
+                return False
+
+    # the backend only answers; the message box is shown here
+    def enough_funds(self, fund, amount):
+        if super().enough_funds(fund, amount):
+            return True
+        mbox(_('Insufficient Funds'),
+             _('There is not enough money in a fund to continue this transaction.'),
+             b1=_('Ok'), b2=None)
+        return False
+
     # When an row is double-clicked from treeview, a new window appears showing all transactions for a particular
     # transaction
     def generate_ledger_window(self, valuestring):
@@ -1008,15 +1223,15 @@ class UserInterface(BaseProgram):
         tree.grid(column=0, row=2)
         tree.config(columns=('A', 'B', 'C', 'D', 'E', 'F', 'G', 'H'))
 
-        tree.heading('#0', text=_('#'), command=lambda: self.sort_column(self.tree, '#0', False))
-        tree.heading('#1', text=_('Date'), command=lambda: self.sort_date_column(self.tree, '#1', False))
-        tree.heading('#2', text=_('Account'), command=lambda: self.sort_column(self.tree, '#2', False))
-        tree.heading('#3', text=_('Base'), command=lambda: self.sort_column(self.tree, '#3', False))
-        tree.heading('#4', text=_('Debit'), command=lambda: self.sort_column(self.tree, '#4', False))
-        tree.heading('#5', text=_('Credit'), command=lambda: self.sort_column(self.tree, '#5', False))
-        tree.heading('#6', text=_('Ex-Rate'), command=lambda: self.sort_column(self.tree, '#6', False))
-        tree.heading('#7', text=_('Memo'), command=lambda: self.sort_column(self.tree, '#7', False))
-        tree.heading('#8', text=_('Payee'), command=lambda: self.sort_column(self.tree, '#8', False))
+        tree.heading('#0', text=_('#'), command=lambda: self.sort_column(tree, '#0', False))
+        tree.heading('#1', text=_('Date'), command=lambda: self.sort_date_column(tree, '#1', False))
+        tree.heading('#2', text=_('Account'), command=lambda: self.sort_column(tree, '#2', False))
+        tree.heading('#3', text=_('Base'), command=lambda: self.sort_column(tree, '#3', False))
+        tree.heading('#4', text=_('Debit'), command=lambda: self.sort_column(tree, '#4', False))
+        tree.heading('#5', text=_('Credit'), command=lambda: self.sort_column(tree, '#5', False))
+        tree.heading('#6', text=_('Ex-Rate'), command=lambda: self.sort_column(tree, '#6', False))
+        tree.heading('#7', text=_('Memo'), command=lambda: self.sort_column(tree, '#7', False))
+        tree.heading('#8', text=_('Payee'), command=lambda: self.sort_column(tree, '#8', False))
         tree.column('#0', stretch=False, width=50)
         tree.column('#1', stretch=False, width=90)
         tree.column('#2', stretch=False, width=150)
@@ -1027,27 +1242,26 @@ class UserInterface(BaseProgram):
         tree.column('#7', stretch=False, width=150)
         tree.column('#8', stretch=False, width=120)
 
-        for entry in self.ledger:
-            if entry[0] == int(valuestring):
-                a = list()
-                a.append(entry[0])  # add transaction date because
-                for x in entry[1:]:  # don't change transaction number
-                    if x == 0:
-                        a.append('')
-                    elif x is None:
-                        a.append('')
-                    else:
-                        a.append(x)
-                # create a row & add odd or even tags to it (for coloring later)
-                if len(tree.get_children('')) % 2 == 0:
-                    tree.insert('', 'end', text=a[0], tags='evenrow',
-                                values=(a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8]))
+        for index, entry in enumerate(self.transaction_rows(int(valuestring))):
+            a = list()
+            a.append(entry[0])  # add transaction date because
+            for x in entry[1:]:  # don't change transaction number
+                if x == 0:
+                    a.append('')
+                elif x is None:
+                    a.append('')
                 else:
-                    tree.insert('', 'end', text=a[0], tags='oddrow',
-                                values=(a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8]))
+                    a.append(x)
+            # create a row & add odd or even tags to it (for coloring later)
+            if index % 2 == 0:
+                tree.insert('', 'end', text=a[0], tags='evenrow',
+                            values=(a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8]))
+            else:
+                tree.insert('', 'end', text=a[0], tags='oddrow',
+                            values=(a[1], a[2], a[3], a[4], a[5], a[6], a[7], a[8]))
 
-            # color odd rows
-            tree.tag_configure('oddrow', background=self.secondary)
+        # color odd rows
+        tree.tag_configure('oddrow', background=self.secondary)
 
     # Double Clicking a row in treeview
     def _on_doubleclick(self, *args):
@@ -1057,17 +1271,24 @@ class UserInterface(BaseProgram):
 
     def _on_right_click(self, *args):
         self.tree.focus()
-        self.tree.yview_moveto(1)
+        self.page_top = len(self.page_rows)
+        self.render_fund_page()
         print(args)
 
-    # Enabling the ability for columns to sort alphabetically in treeview
+    # Enabling the ability for columns to sort in treeview (numbers as numbers, text alphabetically)
+    # The fund page only holds the visible rows, so its sorting is done on the page's data
     def sort_column(self, tv, col, reverse):
-        array = [(tv.set(k, col), k) for k in tv.get_children('')]
-        array.sort(reverse=reverse)
+        if tv is self.tree and self.page_loading:
+            return
+        elif tv is self.tree:
+            self.sort_fund_page(col, reverse, value_sort_key)
+        else:
+            array = [(tv.set(k, col), k) for k in tv.get_children('')]
+            array.sort(key=lambda x: value_sort_key(x[0]), reverse=reverse)
 
-        # rearrange items in sorted positions
-        for index, (val, k) in enumerate(array):
-            tv.move(k, '', index)
+            # rearrange items in sorted positions
+            for index, (val, k) in enumerate(array):
+                tv.move(k, '', index)
 
         # reverse sort next time
         tv.heading(col, command=lambda col=col: self.sort_column(tv, col, not reverse))
@@ -1075,16 +1296,36 @@ class UserInterface(BaseProgram):
     # When clicking on a 'date column' in the treeview, the date appropriate sorts
     # This puts the string value 'DD/MM/YYYY' into an actual date and then sorts those values
     def sort_date_column(self, tv, col, reverse):
-        array = [(tv.set(k, col), k) for k in tv.get_children('')]
-        array.sort(key=lambda x: datetime.datetime.strptime(x[0], '%d/%m/%Y'), reverse=reverse)
+        if tv is self.tree and self.page_loading:
+            return
+        elif tv is self.tree:
+            self.sort_fund_page(col, reverse, date_sort_key)
+        else:
+            array = [(tv.set(k, col), k) for k in tv.get_children('')]
+            array.sort(key=lambda x: date_sort_key(x[0]), reverse=reverse)
 
-        # rearrange items in sorted positions
-        for index, (val, k) in enumerate(array):
-            tv.move(k, '', index)
+            # rearrange items in sorted positions
+            for index, (val, k) in enumerate(array):
+                tv.move(k, '', index)
 
         # reverse sort next time
         tv.heading(col, command=lambda col=col: self.sort_date_column(tv, col, not reverse))
 
+    # Puts the fund page in the order of one column and redraws it once.
+    # The sorted order of each column is worked out once per page and reused after that.
+    def sort_fund_page(self, col, reverse, key):
+        if col not in self.page_sorts:
+            keys = [key(page_cell(row, col)) for row in self.page_source]
+            self.page_sorts[col] = sorted(range(len(keys)), key=keys.__getitem__)
+        order = self.page_sorts[col]
+        if reverse:
+            order = reversed(order)
+        self.page_rows = [self.page_source[i] for i in order]
+        if self.page_filter is not None:
+            self.page_rows = [row for row in self.page_rows if row[0] in self.page_filter]
+        self.page_top = 0
+        self.render_fund_page()
+
     def callback(self, word):
         print(word)
         print(self.secondary)
@@ -1098,25 +1339,30 @@ class UserInterface(BaseProgram):
             self.win_window_open = False
             window.destroy()
 
+    # saves whatever the autosave hasn't got to yet before closing
     def on_exit(self):
+        self.autosaver.stop()
+        if self.autosave_snapshot() is not None:
+            try:
+                self.save_to_file(self.ledger, self.settings)
+            except LedgerError as error:
+                show_error(error)
         self.master.destroy()
 
+    # Narrows the fund page down to the transactions matching the search box.
+    # Every word typed has to match the start of a word in the memo, payee, account or amounts.
+    # The lookup goes through the search index, so rows that were never drawn are found too.
     def search_treeview(self, item=''):
         pattern = self._toSearch.get()
 
-        if len(pattern) > 0:
-            children = self.tree.get_children(item)
-            array = []
-            for child in children:
-                text = self.tree.item(child, 'values')
-
-                for x in text:
-                    if pattern.lower() in x.lower():
-                        array.append(child)
-
-            self.tree.selection_set(array)
+        if len(pattern.strip()) > 0:
+            self.page_filter = self.search_ledger(pattern)
+            self.page_rows = [row for row in self.page_source if row[0] in self.page_filter]
         else:
-            self.tree.selection_remove(self.tree.selection())
+            self.page_filter = None
+            self.page_rows = self.page_source
+        self.page_top = 0
+        self.render_fund_page()
 
     # populates the labels that declare totals of all funds on menu frame
     def populate_directory_amounts(self):
@@ -1128,9 +1374,9 @@ class UserInterface(BaseProgram):
                                               bg=self.primary, width=8,
                                               borderwidth=2, relief='ridge'))
             directory_amounts[-1].grid(column=1, row=i+2, sticky='nse')
-            try:
-                directory_amounts[-1].configure(text=self.load_fund(x)[-1][4])
-            except IndexError:
+            if self.has_postings(x):
+                directory_amounts[-1].configure(text=self.fund_balance(x))
+            else:
                 directory_amounts[-1].configure(text=(format(0, '.2f')))
 
     # generate a report by calling the calculate_balance_sheet
@@ -1141,17 +1387,86 @@ class UserInterface(BaseProgram):
                                                     defaultextension='.pdf',
                                                     initialfile=document,
                                                     filetypes=(("pdf files", "*.pdf"), ("all files", "*.*")))
+            if not filepath:  # the dialog was cancelled
+                return
             write_balance_sheet(self.settings['Church Name'], self.calculate_balance_sheet(),
                                 filepath=filepath)
             logger.info("File %s created." % document)
         except FileNotFoundError:
             return
+        except LedgerError as error:
+            show_error(error)
+
+    # asks for the dates an income statement or fund statements should cover
+    def set_report_window(self, report):
+        title = {'income_statement': _('Income Statement'), 'fund_statements': _('Fund Statements')}[report]
+        window = tk.Toplevel()
+        window.title(title)
+        window.configure(background=self.primary, padx=5, pady=5)
+
+        ttk.Label(window, text=title, style='header2.TLabel').grid(column=0, row=0, columnspan=2, pady=(0, 10))
+        today = datetime.datetime.now()
+        start_label = ttk.Label(window, text=_('From (DD/MM/YYYY)'), justify='left', style="color.TLabel")
+        start_input = ttk.Combobox(window, values=today.strftime('01/01/%Y'), width=15, font=(self.FONT, self.SIZE))
+        start_label.grid(column=0, row=1, sticky='w')
+        start_input.grid(column=1, row=1, sticky='e')
+        end_label = ttk.Label(window, text=_('To (DD/MM/YYYY)'), justify='left', style="color.TLabel")
+        end_input = ttk.Combobox(window, values=today.strftime('%d/%m/%Y'), width=15, font=(self.FONT, self.SIZE))
+        end_label.grid(column=0, row=2, sticky='w')
+        end_input.grid(column=1, row=2, sticky='e')
+        note = ttk.Label(window, text=_('Leave a date empty to include everything on that side.'), style="color.TLabel")
+        note.grid(column=0, row=3, columnspan=2, sticky='w', pady=5)
+
+        generate = ttk.Button(window, text=_('Generate'), style="color.TButton",
+                              command=lambda: self.generate_period_report(report, title, window, start_input.get(),
+                                                                          end_input.get()))
+        generate.grid(column=0, row=4, columnspan=2, sticky='we')
+        start_input.focus()
+
+    # draws an income statement or fund statements for the dates given, empty for no limit
+    def generate_period_report(self, report, title, window, start, end):
+        start, end = start.strip() or None, end.strip() or None
+        for date in (start, end):
+            if date is not None and not check_date(date):
+                return
+        if report == 'income_statement':
+            writer, data = write_income_statement, self.calculate_income_statement
+        else:
+            writer, data = write_fund_statements, self.calculate_fund_statements
+        try:
+            document = '{} {}.pdf'.format(datetime.datetime.now().strftime("%Y-%m-%d"), title)
+            filepath = filedialog.asksaveasfilename(initialdir=os.getcwd(), title="Select file",
+                                                    defaultextension='.pdf',
+                                                    initialfile=document,
+                                                    filetypes=(("pdf files", "*.pdf"), ("all files", "*.*")))
+            if not filepath:  # the dialog was cancelled
+                return
+            writer(self.settings['Church Name'], data((start, end)), filepath=filepath)
+            logger.info("File %s created." % document)
+        except FileNotFoundError:
+            return
+        except LedgerError as error:
+            show_error(error)
+            return
+        window.destroy()
 
     # saves ledger and settings files
     def save_data(self):
-        self.save_to_file(self.ledger, self.settings)
-        time = datetime.datetime.now().strftime('%H:%M:%S')
-        self.save_label.config(text=_('Last Saved {}').format(time))
+        try:
+            self.save_to_file(self.ledger, self.settings)
+        except LedgerError as error:
+            show_error(error)
+            return
+        # another copy of CFAP may have saved in the meantime
+        self.populate_directory_amounts()
+        self.show_saved()
+
+    def show_saved(self, when=None):
+        time = datetime.datetime.fromtimestamp(when) if when is not None else datetime.datetime.now()
+        self.save_label.config(text=_('Last Saved {}').format(time.strftime('%H:%M:%S')))
+
+    def show_save_failed(self, error):
+        self.save_label.config(text=_('Autosave failed: {}').format(error))
 
     # clears name prompts saved in settings
     def clear_name_prompts(self):
@@ -1160,6 +1475,8 @@ class UserInterface(BaseProgram):
 
     # set up the settingUI window
     def set_settings_window(self, settings_type):
+        if not self.writable():
+            return
         # Configuration of Settings Window
         self.settings_window = tk.Toplevel()
         self.settings_window.protocol('WM_DELETE_WINDOW', lambda: self.close_window(self.settings_window))
@@ -1779,9 +2096,34 @@ class UserInterface(BaseProgram):
 
     # saves settings
     def save_all_to_file(self):
-        # save settings to file
-        with open('resources/settings.json', 'w+', encoding='utf-8') as doc1:
-            json.dump(self.settings, doc1, indent=2)
+        try:
+            self.save_settings()
+        except LedgerError as error:
+            show_error(error)
+
+    # False, after saying why, when the ledger can't be changed (an archive opened read-only)
+    def writable(self):
+        try:
+            self.check_writable()
+        except LedgerError as error:
+            show_error(error)
+            return False
+        return True
+
+
+# shows an error raised by the backend
+def show_error(error):
+    mbox(_(error.title), str(error), b1=_('Ok'), b2=None)
+
+
+# True if the date is real and written DD/MM/YYYY, otherwise says what is wrong with it
+def check_date(date):
+    try:
+        validate_date(date)
+        return True
+    except DateError as error:
+        show_error(error)
+        return False
 
 
 # Creates a directory for a user to import an older ledger
@@ -1906,6 +2248,37 @@ def extract_data(matrix_name):
             return None
 
 
+# the value a (text, values) fund page row shows in Treeview column '#n'
+def page_cell(row, col):
+    if col == '#0':
+        return row[0]
+    return row[1][int(col[1:]) - 1]
+
+
+# Sort key for a Treeview value: amounts and numbers by value (a blank cell counts as 0),
+# then anything else alphabetically
+def value_sort_key(value):
+    if value == '' or value is None:
+        return 0, D('0'), ''
+    if isinstance(value, (int, decimal.Decimal)):
+        return 0, value, ''
+    try:
+        number = D(value)
+    except decimal.InvalidOperation:
+        number = None
+    if number is not None and number.is_finite():
+        return 0, number, ''
+    return 1, D('0'), str(value).lower()
+
+
+# Sort key for a 'DD/MM/YYYY' date; anything unreadable goes first
+def date_sort_key(value):
+    ordinal = date_ordinal(value)
+    if ordinal is None:
+        return -1
+    return ordinal
+
+
 # Enables entries to only accept numerical values and '.'
 def num_validation(value):
     if value == '.':
@@ -2006,9 +2379,12 @@ tk.Tk.report_callback_exception = lambda self, exc, val, tb: exception_hook(logg
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CFAP')
+    parser.add_argument('--archive', help='open an archive folder read-only (see binformat.py)')
+    args = parser.parse_args()
     try:
         root = tk.Tk()
-        ui = UserInterface(root)
+        ui = UserInterface(root, args.archive)
 
         root.mainloop()
     except exception as e:
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Rounding of money to a currency's minor units (cents, kopecks, yen), worked out exactly
+# and done in one place with one rule: half away from zero, as decimal.ROUND_HALF_UP has
+# always done for the ledger. Amounts arrive as Decimals, strings, ints or the floats JSON
+# gives back, and leave as Decimals: the ledger rows, balances, settings and windows all
+# keep using Decimal.
+
+from storage import to_text
+import decimal
+
+D = decimal.Decimal
+EXPONENT = 2  # minor-unit digits of any currency not listed below
+# Currencies without minor units. Ones with three digits (BHD, KWD, ...) are left at two,
+# since the columnar and binary forms of the ledger hold whole cents.
+EXPONENTS = {'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0, 'KRW': 0,
+             'PYG': 0, 'RWF': 0, 'UGX': 0, 'VND': 0, 'VUV': 0, 'XAF': 0, 'XOF': 0, 'XPF': 0}
+
+
+# minor-unit digits of a currency code such as 'UAH'
+def exponent(currency):
+    return EXPONENTS.get(currency, EXPONENT)
+
+
+# numerator / denominator rounded to a whole number, halves away from zero
+def round_half_up(numerator, denominator):
+    whole, rest = divmod(abs(numerator), denominator)
+    if rest * 2 >= denominator:
+        whole += 1
+    return whole if numerator >= 0 else -whole
+
+
+# an amount as an exact (numerator, denominator) pair
+def ratio(value):
+    if isinstance(value, int):
+        return value, 1
+    if not isinstance(value, D):
+        value = D(to_text(value))
+    return value.as_integer_ratio()
+
+
+# Minor units of an amount, or of amount * rate when a rate is given, worked out exactly
+# and rounded once. Amounts already in whole minor units skip the fractions.
+def to_units(value, exponent=EXPONENT, rate=None):
+    if rate is None:
+        if isinstance(value, int):
+            return value * 10 ** exponent
+        if not isinstance(value, D):
+            value = D(to_text(value))
+        scaled = value.scaleb(exponent)
+        whole = int(scaled)
+        if whole == scaled:
+            return whole
+        numerator, denominator = value.as_integer_ratio()
+    else:
+        numerator, denominator = ratio(value)
+        times, over = ratio(rate)
+        numerator *= times
+        denominator *= over
+    return round_half_up(numerator * 10 ** exponent, denominator)
+
+
+# minor units -> Decimal with exactly 'exponent' places, e.g. 1230 -> Decimal('12.30')
+def from_units(units, exponent=EXPONENT):
+    return D(units).scaleb(-exponent)
+
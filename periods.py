@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+from errors import DateError
+from storage import date_ordinal
+import simplejson as json
+import bisect
+import calendar
+import datetime
+import logging
+import os
+
+# NumPy is optional: it only keeps the index of a read-only ledger compact
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Logging Set Up
+logger = logging.getLogger(__name__)
+
+CLOSES = 'resources/snapshots.json'
+
+
+# Ledger positions kept in date order, so the rows between two dates are two bisects
+# away instead of a parse of every row. Rows whose date can't be read are left out.
+class DateIndex:
+
+    def __init__(self, ordinals=()):
+        pairs = sorted((int(ordinal), position) for position, ordinal in enumerate(ordinals) if ordinal >= 0)
+        self.ordinals = [ordinal for ordinal, position in pairs]
+        self.positions = [position for ordinal, position in pairs]
+
+    # For a ledger that never grows (an archive): with NumPy the index is kept as two
+    # arrays instead of two lists of Python ints. add() can't be used on it.
+    @classmethod
+    def frozen(cls, ordinals):
+        if np is None or not isinstance(ordinals, np.ndarray):
+            return cls(ordinals)
+        index = cls()
+        positions = np.flatnonzero(ordinals >= 0)
+        order = np.argsort(ordinals[positions], kind='stable')
+        index.positions = positions[order]
+        index.ordinals = ordinals[index.positions]
+        return index
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    # new rows are nearly always the latest date, so this is usually an append
+    def add(self, ordinal, position):
+        if ordinal is None or ordinal < 0:
+            return
+        if not self.ordinals or ordinal >= self.ordinals[-1]:
+            self.ordinals.append(ordinal)
+            self.positions.append(position)
+        else:
+            at = bisect.bisect_right(self.ordinals, ordinal)
+            self.ordinals.insert(at, ordinal)
+            self.positions.insert(at, position)
+
+    # positions of the rows dated after 'start' up to and including 'end' (ordinals, None = open)
+    def positions_between(self, start=None, end=None):
+        first = 0 if start is None else bisect.bisect_right(self.ordinals, start)
+        last = len(self.ordinals) if end is None else bisect.bisect_right(self.ordinals, end)
+        return self.positions[first:last]
+
+    def first(self):
+        return self.ordinals[0] if len(self.ordinals) else None
+
+
+# Every account's balance (debits minus credits, in cents) at the end of each month,
+# so a balance as of any date is the nearest month-end plus the few rows after it.
+# Saved to CLOSES as {'rows': ledger rows covered, 'closes': {ordinal: {number: cents}}}.
+# A posting dated on or before a month-end drops that close and every later one.
+class PeriodCloses:
+
+    def __init__(self, path=CLOSES):
+        self.path = path  # None for a read-only ledger, whose closes are only kept in memory
+        self.closes = {}  # month-end ordinal -> {account number: cents}
+        self.ends = []  # sorted keys of self.closes
+
+    # read the saved closes, dropping any that rows saved after them have back-dated
+    def load(self, arrays):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as doc:
+                saved = json.load(doc)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning("Ignoring unreadable period closes %s.", self.path)
+            return
+        if saved['rows'] > len(arrays):
+            logger.warning("Period closes in %s are for a longer ledger; rebuilding them.", self.path)
+            return
+        self.closes = {int(end): balances for end, balances in saved['closes'].items()}
+        self.ends = sorted(self.closes)
+        later = [ordinal for ordinal in arrays.ordinals[saved['rows']:] if ordinal >= 0]
+        if later:
+            self.invalidate(min(later))
+
+    # closes may be a copy of self.closes taken when the ledger had 'rows' rows
+    def save(self, rows, closes=None):
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as doc:
+            json.dump({'rows': rows, 'closes': self.closes if closes is None else closes}, doc)
+        os.replace(temp, self.path)
+
+    # a row dated 'ordinal' has been posted: closes on or after it are wrong now
+    def invalidate(self, ordinal):
+        if ordinal is None or not self.ends or ordinal > self.ends[-1]:
+            return
+        at = bisect.bisect_left(self.ends, ordinal)
+        for end in self.ends[at:]:
+            del self.closes[end]
+        del self.ends[at:]
+
+    # records every month-end from the last close up to 'through' (an ordinal)
+    def close_through(self, through, arrays, date_index):
+        if date_index.first() is None:
+            return
+        if self.ends:
+            start = self.ends[-1]
+            balances = dict(self.closes[start])
+            end = month_end(start + 1)
+        else:
+            start = None
+            balances = {}
+            end = month_end(date_index.first())
+        # month-ends after the latest posting would all be the same, so stop there
+        through = min(through, date_index.ordinals[-1])
+        while end <= through:
+            self.add_rows(balances, date_index.positions_between(start, end), arrays)
+            self.closes[end] = dict(balances)
+            self.ends.append(end)
+            start, end = end, month_end(end + 1)
+
+    @staticmethod
+    def add_rows(balances, positions, arrays):
+        for position in positions:
+            number = arrays.numbers[arrays.accounts[position]]
+            balances[number] = balances.get(number, 0) + int(arrays.debits[position] - arrays.credits[position])
+
+    # {account number: cents} as of the end of the day 'ordinal'
+    def balances_as_of(self, ordinal, arrays, date_index):
+        self.close_through(closed_month_end(ordinal), arrays, date_index)
+        at = bisect.bisect_right(self.ends, ordinal)
+        if at:
+            start = self.ends[at - 1]
+            balances = dict(self.closes[start])
+        else:
+            start = None
+            balances = {}
+        self.add_rows(balances, date_index.positions_between(start, ordinal), arrays)
+        return balances
+
+
+# ordinal of the last day of the month holding 'ordinal'
+def month_end(ordinal):
+    day = datetime.date.fromordinal(ordinal)
+    return datetime.date(day.year, day.month, calendar.monthrange(day.year, day.month)[1]).toordinal()
+
+
+# ordinal of the last month-end on or before 'ordinal'
+def closed_month_end(ordinal):
+    if month_end(ordinal) == ordinal:
+        return ordinal
+    return datetime.date.fromordinal(ordinal).replace(day=1).toordinal() - 1
+
+
+# 'DD/MM/YYYY' -> ordinal, raising DateError for a date that can't be read
+def as_of_ordinal(date):
+    ordinal = date_ordinal(date)
+    if ordinal is None:
+        raise DateError(_('Please enter the date in format DD/MM/YYYY.'))
+    return ordinal
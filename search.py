@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+import bisect
+import decimal
+import re
+
+D = decimal.Decimal
+WORD = re.compile(r'[\w.]+')
+
+
+# Inverted index over the ledger's text: memo, payee, account and amounts.
+# Every word maps to the transaction numbers it appears in, and the words are kept
+# sorted so a prefix ('off' -> 'offering', 'offerings') is a bisect instead of a scan.
+class SearchIndex:
+
+    def __init__(self, rows=()):
+        self.postings = {}  # {word: {trans#}}
+        self.words = []  # sorted list of every word in self.postings
+        self.add_rows(rows)
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add_row(row, keep_sorted=False)
+        self.words = sorted(self.postings)
+
+    # index one ledger row: [trans#, date, account, base, debit, credit, exrate, memo, payee]
+    def add_row(self, row, keep_sorted=True):
+        trans = row[0]
+        for word in row_words(row):
+            try:
+                self.postings[word].add(trans)
+            except KeyError:
+                self.postings[word] = {trans}
+                if keep_sorted:
+                    bisect.insort(self.words, word)
+
+    # transaction numbers matching every term of the query, each term as a prefix
+    def search(self, query):
+        matches = None
+        for term in split_words(query):
+            found = set()
+            position = bisect.bisect_left(self.words, term)
+            while position < len(self.words) and self.words[position].startswith(term):
+                found |= self.postings[self.words[position]]
+                position += 1
+            if matches is None:
+                matches = found
+            else:
+                matches &= found
+            if not matches:
+                break
+        if matches is None:
+            return set()
+        return matches
+
+
+# the searchable words of a ledger row
+def row_words(row):
+    words = set()
+    for text in (row[2], row[7], row[8]):
+        if text:
+            words.update(split_words(text))
+    for amount in (row[3], row[4], row[5]):
+        if amount:
+            words.add(amount_text(amount))
+    if row[6] is not None:
+        words.add(number_text(row[6]))
+    return words
+
+
+def split_words(text):
+    return [word.strip('.') for word in WORD.findall(text.lower()) if word.strip('.')]
+
+
+# amounts from JSON may be floats; index them the way the ledger pages show them
+def amount_text(amount):
+    return str(D(number_text(amount)).quantize(D('.01'), decimal.ROUND_HALF_UP))
+
+
+def number_text(number):
+    if isinstance(number, float):
+        return repr(number)
+    return str(number)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+# A small HTTP/JSON server so several people can post to one ledger at the same time:
+#   python server.py [--host 127.0.0.1] [--port 8765]
+#
+#   GET  /balances                      {fund number: balance}
+#   GET  /balance-sheet[?date=DD/MM/YYYY]
+#   GET  /funds/<number>                the fund's rows, as load_fund returns them
+#   GET  /ledger?from=DD/MM/YYYY&to=DD/MM/YYYY   the ledger rows dated in between, both included
+#   GET  /periods/<month|quarter|year>[?fund=<number>&end=DD/MM/YYYY]   debit and credit totals
+#   POST /offerings   {"date", "currencies", "amount", "memo"}
+#   POST /expenses    {"date", "debit", "credit", "debit_amount", "credit_amount", "memo", "payee", "force"}
+#
+# Alternate currency amounts are written {"amount": ..., "exrate": ...}. Postings are checked the
+# way batchimport checks a file: known accounts, positive amounts and, for expenses, debits equal
+# to credits. Every posting goes through one writer task, in the order it arrived, and is saved
+# before the next one starts; a posting that fails partway, or can't be saved, is rolled back.
+# The ledger is only changed on the event loop's thread, and written to disk on another so reads
+# carry on meanwhile. Balances and the current balance sheet are answered from a cache the
+# writer replaces after each posting.
+
+from backend import BaseProgram, validate_date, account_number
+from batchimport import validate, BatchError
+from errors import LedgerError, AccountError, TransactionError, InsufficientFundsError, ConflictError
+import simplejson as json
+import argparse
+import asyncio
+import decimal
+import logging
+import urllib.parse
+
+# Logging Set Up
+logger = logging.getLogger(__name__)
+
+HOST = '127.0.0.1'  # local only
+PORT = 8765
+MAX_BODY = 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class LedgerServer:
+
+    def __init__(self, program):
+        self.program = program
+        self.writes = None  # asyncio.Queue of (function, arguments, future), made once the loop runs
+        self.cache = {}
+
+    async def serve(self, host=HOST, port=PORT):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.program.wait_for_ledger)
+        self.writes = asyncio.Queue()
+        self.refresh_cache()
+        writer = asyncio.ensure_future(self.write_postings())
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info("Serving the ledger on http://%s:%s", host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer.cancel()
+
+    # The only task that changes the ledger: one posting at a time, each saved before the next.
+    # Whatever goes wrong, the posting is rolled back unless its rows were already committed,
+    # and the future is always answered, so one failure never holds up the requests behind it.
+    async def write_postings(self):
+        program = self.program
+        while True:
+            function, arguments, future = await self.writes.get()
+            checkpoint = program.checkpoint()
+            result = posted = None
+            try:
+                result = function(*arguments)
+                posted = True
+                self.refresh_cache()
+                await self.save()
+            except Exception as error:
+                if program.store.saved > checkpoint[0]:
+                    # committed before the failure (e.g. writing the summary), so the posting stands
+                    logger.exception("The posting was saved, but not everything after it.")
+                    future.set_result(result)
+                    continue
+                if posted:
+                    logger.exception("Could not save the posting; rolling it back.")
+                program.rollback(checkpoint)
+                try:
+                    self.refresh_cache()
+                except Exception:
+                    logger.exception("Could not refresh the cached balances.")
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    # Ledger and settings, since offerings change the alternate currency records. The rows are
+    # copied here and written on an executor thread (see BaseProgram.autosave_snapshot), which
+    # only reads the ledger. If another program saved meanwhile, its rows are put in first
+    # with a full save on the loop's thread, since that changes the ledger.
+    async def save(self):
+        program = self.program
+        program.close_periods()
+        snapshot = program.autosave_snapshot()
+        if snapshot is None:
+            return
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, program.write_snapshot, snapshot):
+            program.save_to_file(program.ledger, program.settings)
+
+    async def submit(self, function, *arguments):
+        future = asyncio.get_running_loop().create_future()
+        await self.writes.put((function, arguments, future))
+        return await future
+
+    # replaced whole, so a read never sees half of a posting
+    def refresh_cache(self):
+        program = self.program
+        self.cache = {'balances': {number: program.closing_balance(number) for number in program.get_funds()},
+                      'balance_sheet': program.calculate_balance_sheet()}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, colon, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, {'error': 'request body is too large'}, False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status, payload = await self.dispatch(method, target, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def respond(writer, status, payload, keep_alive):
+        data = json.dumps(payload, ensure_ascii=False, use_decimal=True).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                     'Content-Length: {}\r\nConnection: {}\r\n\r\n'
+                     .format(status, REASONS[status], len(data), 'keep-alive' if keep_alive else 'close')
+                     .encode('latin-1') + data)
+        await writer.drain()
+
+    async def dispatch(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        path = url.path.rstrip('/')
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            if method == 'GET':
+                if path == '/balances':
+                    return 200, self.cache['balances']
+                elif path == '/balance-sheet':
+                    if 'date' in query:
+                        return 200, self.program.calculate_balance_sheet(query['date'][0])
+                    return 200, self.cache['balance_sheet']
+                elif path.startswith('/funds/'):
+                    return 200, self.program.load_fund(path[len('/funds/'):])
+                elif path == '/ledger':
+                    return 200, self.program.rows_between(query['from'][0], query['to'][0])
+                elif path.startswith('/periods/'):
+                    end = query['end'][0] if 'end' in query else None
+                    if end is not None:
+                        validate_date(end)
+                    fund = query['fund'][0] if 'fund' in query else None
+                    return 200, self.program.period_report(path[len('/periods/'):], fund, end)
+            elif method == 'POST':
+                if path in ('/offerings', '/expenses'):
+                    try:
+                        entry = json.loads(body.decode('utf-8'), use_decimal=True)
+                    except ValueError:
+                        return 400, {'error': 'the body is not JSON'}
+                    if not isinstance(entry, dict):
+                        return 400, {'error': 'the body must be a JSON object'}
+                    if path == '/offerings':
+                        transaction = await self.submit(self.post_offering, entry)
+                    else:
+                        transaction = await self.submit(self.post_expense, entry)
+                    return 200, {'transaction': transaction}
+            else:
+                return 405, {'error': '{} is not supported'.format(method)}
+        except (InsufficientFundsError, ConflictError) as error:
+            return 409, {'error': str(error), 'type': type(error).__name__}
+        except BatchError as error:
+            return 400, {'error': 'the posting is not valid', 'type': type(error).__name__,
+                         'errors': [message for posting, message in error.errors]}
+        except LedgerError as error:
+            return 400, {'error': str(error), 'type': type(error).__name__}
+        except (KeyError, TypeError) as error:
+            return 400, {'error': 'missing or malformed field {}'.format(error)}
+        except (decimal.InvalidOperation, ValueError, IndexError) as error:
+            return 400, {'error': 'malformed value: {}'.format(error or type(error).__name__)}
+        except OSError:
+            return 500, {'error': 'the ledger could not be saved'}
+        return 404, {'error': 'no such resource'}
+
+    # run by the writer task; return the transaction number used
+    def post_offering(self, entry):
+        program = self.program
+        validate_date(entry['date'])
+        currencies, amount = entry['currencies'], amounts(entry['amount'])
+        # the currencies are what is given; the allocations and funds are worked out from settings
+        for currency in currencies if isinstance(currencies, list) else [currencies]:
+            if account_number(currency) not in program.settings['accounts']['assets']:
+                raise AccountError('{} is not an asset account'.format(currency))
+        self.check(entry, as_postings(currencies, amount, 'debit'), balanced=False)
+        program.add_offering(entry['date'], currencies, amount, entry['memo'])
+        return program.transaction - 1
+
+    def post_expense(self, entry):
+        program = self.program
+        validate_date(entry['date'])
+        debit, debit_amount = entry['debit'], amounts(entry['debit_amount'])
+        credit, credit_amount = entry['credit'], amounts(entry['credit_amount'])
+        self.check(entry, as_postings(debit, debit_amount, 'debit') + as_postings(credit, credit_amount, 'credit'))
+        if not program.enough_funds(credit, credit_amount):
+            raise InsufficientFundsError(_('There is not enough money in a fund to continue this transaction.'))
+        # alternate currencies paid out come off their exchange-rate records first, as in the window
+        pairs = zip(credit, credit_amount) if isinstance(credit, list) else [(credit, credit_amount)]
+        for fund, value in pairs:
+            if isinstance(value, tuple):
+                program.subtract_from_alt_currency_records(fund, value[0], value[1], force=entry.get('force', False))
+        program.add_expense(entry['date'], debit, credit, debit_amount, credit_amount, entry['memo'], entry.get('payee'))
+        return program.transaction - 1
+
+    # raises BatchError unless the postings' accounts are known and their amounts readable
+    # (and, if balanced, the debits equal the credits)
+    def check(self, entry, postings, balanced=True):
+        validate(self.program, [{'line': 1, 'date': entry['date'], 'memo': entry.get('memo'),
+                                 'payee': entry.get('payee'), 'postings': postings}], balanced)
+
+
+# {"amount": ..., "exrate": ...} -> the (amount, exrate) tuples the add_* methods expect
+def amounts(value):
+    if isinstance(value, list):
+        return [amounts(item) for item in value]
+    elif isinstance(value, dict):
+        return value['amount'], value['exrate']
+    return value
+
+
+# an account or list of accounts and their amounts as batchimport postings on one side,
+# numbered from 1 in the order given
+def as_postings(accounts, values, side):
+    if not isinstance(accounts, list):
+        accounts, values = [accounts], [values]
+    if not isinstance(values, list) or len(accounts) != len(values):
+        raise TransactionError('give one amount for each account')
+    result = []
+    for number, (account, value) in enumerate(zip(accounts, values), 1):
+        amount, exrate = value if isinstance(value, tuple) else (value, None)
+        result.append({'line': number, 'account': account, 'debit': amount if side == 'debit' else None,
+                       'credit': amount if side == 'credit' else None, 'exrate': exrate})
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the CFAP ledger over HTTP on this computer.')
+    parser.add_argument('--host', default=HOST, help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on (default: %(default)s)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = LedgerServer(BaseProgram())
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -63,7 +63,7 @@ setup(
 
     install_requires=MODULES,
     options={'py2app': OPTIONS},
-    py_modules=['backend', 'buildreports', 'calculator', 'mbox'],
+    py_modules=['backend', 'buildreports', 'calculator', 'mbox', 'storage', 'columnar', 'search', 'analytics', 'periods', 'batchimport', 'errors', 'server', 'autosave', 'binformat', 'money'],
     data_files=DATA_FILES,
     
     classifiers=[
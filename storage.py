@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+
+import simplejson as json
+import argparse
+import datetime
+import decimal
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# advisory locks: fcntl on Mac/Linux, msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Logging Set Up
+logger = logging.getLogger(__name__)
+
+SNAPSHOT = 'resources/matrices.txt'
+BINARY_SNAPSHOT = 'resources/ledger.bin'  # used instead with the setting "snapshot_format": "binary"
+JOURNAL = 'resources/journal.txt'
+DATABASE = 'resources/ledger.db'
+SUMMARY = 'resources/summary.json'
+LOCK = 'resources/ledger.lock'
+COUNTER = 'resources/transaction.txt'
+SETTINGS = 'resources/settings.json'
+MANIFEST = 'resources/manifest.json'
+RECENT_ROWS = 100  # rows kept in the summary so the General Ledger can open before the rest loads
+COMPACT_AFTER = 5000  # journal rows written before the snapshot is rewritten
+
+
+# The ledger is kept as a snapshot (a JSON array, as matrices.txt has always been)
+# plus an append-only journal holding the rows posted since the snapshot was written.
+# One journal line per ledger row:
+#   [position, trans#, date, account, base, debit, credit, exrate, memo, payee]
+# The position lets the loader skip rows that already made it into the snapshot,
+# so an interrupted compaction never duplicates a row.
+# Each save ends by committing the manifest (see commit_generation), and only the part of
+# the journal the manifest covers is read, so a save cut short leaves the last one intact.
+# With binary=True the snapshot is written in the format of binformat.py; either format
+# is read, and a binary snapshot loads as a ColumnarLedger.
+class JournalStore:
+
+    def __init__(self, snapshot=SNAPSHOT, journal=JOURNAL, compact_after=COMPACT_AFTER, manifest=MANIFEST,
+                 binary=False):
+        self.snapshot = snapshot
+        self.journal = journal
+        self.compact_after = compact_after
+        self.manifest = manifest
+        self.binary = binary
+        self.saved = 0  # number of ledger rows already on disk
+        self.journal_rows = 0  # number of those rows that live in the journal
+        self.journal_size = 0  # bytes of the journal holding those rows; anything after is cut off
+        self.snapshot_sum = None  # checksum of the snapshot file
+        self.journal_sum = hashlib.sha256()  # running checksum of the journal's first journal_size bytes
+        self.signature = None  # the files as this program last read or wrote them
+
+    # read the snapshot then replay the journal on top of it
+    def load(self):
+        entry = committed_ledger(self.manifest, 'journal')
+        if entry is not None:
+            # a compaction committed just before the snapshot was moved into place
+            roll_forward(self.snapshot, entry['snapshot'])
+        ledger = self.read_snapshot()
+        if entry is not None and self.snapshot_sum != entry['snapshot']:
+            logger.error("%s does not match its checksum from the last save.", self.snapshot)
+        self.journal_rows = 0
+        try:
+            with open(self.journal, 'rb') as doc:
+                data = doc.read()
+        except FileNotFoundError:
+            data = b''
+        if entry is not None:
+            size, journal_sum = entry['journal']
+            if len(data) < size or checksum(data[:size]) != journal_sum:
+                logger.error("%s does not match its checksum from the last save.", self.journal)
+            elif len(data) > size:
+                logger.warning("Ignoring %s bytes of %s written by a save that didn't finish.",
+                               len(data) - size, self.journal)
+                data = data[:size]
+
+        good = 0  # byte offset of the end of the last complete line
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b'\n'):
+                logger.warning("Dropping an incomplete line at the end of %s.", self.journal)
+                break
+            try:
+                row = json.loads(line.decode('utf-8'))
+            except ValueError:
+                logger.error("Unreadable line in %s at byte %s.", self.journal, good)
+                break
+            position = row[0]
+            if position == len(ledger):
+                ledger.append(row[1:])
+                self.journal_rows += 1
+            elif position > len(ledger):
+                logger.error("Journal %s skips from row %s to %s.", self.journal, len(ledger), position)
+                break
+            good += len(line)
+
+        # anything after this is cut off when the next save starts
+        self.journal_size = good
+        self.journal_sum = hashlib.sha256(data[:good])
+        self.saved = len(ledger)
+        if entry is not None and entry['rows'] != self.saved:
+            logger.error("The last save had %s ledger rows but %s were read.", entry['rows'], self.saved)
+        self.signature = self.file_signature()
+        return ledger
+
+    # the snapshot's rows, setting snapshot_sum from the bytes read
+    def read_snapshot(self):
+        # binformat builds on this module, so it is imported once it is needed
+        from binformat import is_binary, read_ledger, map_file
+        try:
+            mapped = map_file(self.snapshot)
+        except (FileNotFoundError, ValueError):  # no snapshot yet, or an empty one
+            self.snapshot_sum = checksum(b'')
+            return []
+        try:
+            self.snapshot_sum = checksum(mapped)
+            if is_binary(mapped):
+                return read_ledger(mapped)
+            return json.loads(mapped[:].decode('utf-8'))
+        finally:
+            mapped.close()
+
+    # a store on the same files that hasn't read anything yet
+    def reopen(self):
+        return JournalStore(self.snapshot, self.journal, self.compact_after, self.manifest, self.binary)
+
+    # what the manifest records about the ledger as it is on disk now
+    def state(self):
+        return {'store': 'journal',
+                'format': 'binary' if self.binary else 'json',
+                'rows': self.saved,
+                'snapshot': self.snapshot_sum or file_checksum(self.snapshot),
+                'journal': [self.journal_size, self.journal_sum.hexdigest()]}
+
+    # True if another program has written the ledger since this one last read or wrote it
+    def changed(self):
+        return self.file_signature() != self.signature
+
+    def file_signature(self):
+        signature = []
+        for path in (self.snapshot, self.journal):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                signature.append(None)
+        return signature
+
+    # Write the rows of the ledger that are not on disk yet and commit them, with the
+    # settings if given, as the next generation. Rows from 'upto' on are left for a later
+    # save. Call it holding the ledger lock.
+    def append(self, ledger, settings=None, upto=None):
+        rows = ledger[self.saved:upto]
+        data = b''.join(json.dumps([position] + list(row), ensure_ascii=False, use_decimal=True).encode('utf-8')
+                        + b'\n' for position, row in enumerate(rows, self.saved))
+        with open(self.journal, 'ab') as doc:
+            # drop whatever a save that didn't finish left after the committed rows
+            doc.truncate(self.journal_size)
+            doc.write(data)
+            doc.flush()
+            os.fsync(doc.fileno())
+        self.journal_size += len(data)
+        self.journal_sum.update(data)
+        self.saved += len(rows)
+        self.journal_rows += len(rows)
+        commit_generation(self.state(), settings, self.manifest)
+
+        if self.journal_rows >= self.compact_after:
+            self.compact(ledger)
+        self.signature = self.file_signature()
+
+    # fold the journal into a fresh snapshot and empty the journal
+    def compact(self, ledger):
+        if self.binary:
+            from binformat import pack
+            data = pack(ledger, self.saved)
+        else:
+            data = json.dumps(ledger[:self.saved], ensure_ascii=False, use_decimal=True).encode('utf-8')
+        stage_file(self.snapshot, data)
+        self.snapshot_sum = checksum(data)
+        self.journal_size = 0
+        self.journal_sum = hashlib.sha256()
+        # from here the new snapshot is the saved one, even if the next steps are cut short
+        commit_generation(self.state(), path=self.manifest)
+        os.replace(self.snapshot + '.tmp', self.snapshot)
+
+        with open(self.journal, 'wb') as doc:
+            doc.flush()
+            os.fsync(doc.fileno())
+        self.journal_rows = 0
+        logger.info("Compacted ledger into %s (%s rows).", self.snapshot, self.saved)
+
+
+# The ledger kept in a local SQLite database, one table row per ledger row.
+# Amounts are stored as text so Decimals come back exactly as they were saved.
+# The position column is the row's index in BaseProgram.ledger. Rows past the count
+# in the manifest belong to a save that didn't finish and are ignored, then replaced.
+class SQLiteStore:
+
+    columns = 'trans, date, account, base, debit, credit, exrate, memo, payee'
+
+    def __init__(self, path=DATABASE, manifest=MANIFEST):
+        self.path = path
+        self.manifest = manifest
+        # SQLite objects only work on the thread that made them, and the ledger is loaded
+        # and autosaved on threads of their own, so each thread gets its own connection
+        self.local = threading.local()
+        self.connections = []
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS postings (
+                position INTEGER PRIMARY KEY,
+                trans INTEGER NOT NULL,
+                date TEXT NOT NULL,
+                ordinal INTEGER,
+                account TEXT NOT NULL,
+                number TEXT NOT NULL,
+                base TEXT,
+                debit TEXT,
+                credit TEXT,
+                exrate TEXT,
+                memo TEXT,
+                payee TEXT
+            );
+            CREATE INDEX IF NOT EXISTS postings_trans ON postings (trans);
+            CREATE INDEX IF NOT EXISTS postings_ordinal ON postings (ordinal);
+            CREATE INDEX IF NOT EXISTS postings_number ON postings (number);
+            CREATE INDEX IF NOT EXISTS postings_payee ON postings (payee);
+        ''')
+        self.saved = 0
+
+    def load(self):
+        entry = committed_ledger(self.manifest, 'sqlite')
+        if entry is not None:
+            ledger = self.select('WHERE position < ? ORDER BY position', (entry['rows'],))
+            if len(ledger) != entry['rows']:
+                logger.error("The last save had %s ledger rows but %s were read.", entry['rows'], len(ledger))
+        else:
+            ledger = self.select('ORDER BY position')
+        self.saved = len(ledger)
+        return ledger
+
+    def state(self):
+        return {'store': 'sqlite', 'rows': self.saved}
+
+    def append(self, ledger, settings=None, upto=None):
+        rows = ledger[self.saved:upto]
+        with self.connection:
+            self.connection.execute('DELETE FROM postings WHERE position >= ?', (self.saved,))
+            if rows:
+                self.connection.executemany(
+                    'INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(position, row[0], row[1], date_ordinal(row[1]), row[2], row[2].split(' ', 1)[0],
+                      to_text(row[3]), to_text(row[4]), to_text(row[5]), to_text(row[6]), row[7], row[8])
+                     for position, row in enumerate(rows, self.saved)])
+        self.saved += len(rows)
+        commit_generation(self.state(), settings, self.manifest)
+
+    # nothing to fold: every row is already in its final place
+    def compact(self, ledger):
+        pass
+
+    def reopen(self):
+        return SQLiteStore(self.path, self.manifest)
+
+    def changed(self):
+        return self.connection.execute('SELECT COUNT(*) FROM postings').fetchone()[0] != self.saved
+
+    # The lookups below use the indexes, and only read the rows the last save committed,
+    # so they can answer while the ledger is still being loaded.
+
+    # rows of one account, e.g. '1010'
+    def fund_rows(self, number):
+        return self.select('WHERE number = ? AND position < ? ORDER BY position', (number, self.committed()))
+
+    # rows of one transaction number
+    def transaction_rows(self, trans):
+        return self.select('WHERE trans = ? AND position < ? ORDER BY position', (trans, self.committed()))
+
+    # rows dated between two 'DD/MM/YYYY' dates, both included, in date order
+    def rows_between(self, start, end):
+        return self.select('WHERE ordinal BETWEEN ? AND ? AND position < ? ORDER BY ordinal, position',
+                           (date_ordinal(start), date_ordinal(end), self.committed()))
+
+    # rows the last save committed, or every row in the table if no save has said
+    def committed(self):
+        entry = committed_ledger(self.manifest, 'sqlite')
+        if entry is None:
+            return self.connection.execute('SELECT COUNT(*) FROM postings').fetchone()[0]
+        return entry['rows']
+
+    # this thread's connection to the database, opened on first use
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # close() may run on another thread, which is the only other place it is used
+            connection = self.local.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connections.append(connection)
+        return connection
+
+    def select(self, clause, parameters=()):
+        cursor = self.connection.execute('SELECT {} FROM postings {}'.format(self.columns, clause), parameters)
+        return [[trans, date, account, to_decimal(base), to_decimal(debit), to_decimal(credit),
+                 to_decimal(exrate), memo, payee]
+                for trans, date, account, base, debit, credit, exrate, memo, payee in cursor]
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.local = threading.local()
+
+
+# An exclusive advisory lock on a file, held for the length of a 'with' block, so
+# programs sharing the resources folder (e.g. on a network drive) take turns saving.
+# Threads of one program sharing a FileLock take turns too.
+class FileLock:
+
+    def __init__(self, path=LOCK):
+        self.path = path
+        self.doc = None
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.doc = open(self.path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.doc.fileno(), fcntl.LOCK_EX)
+        else:
+            self.doc.seek(0)
+            while True:
+                try:  # LK_LOCK gives up after 10 tries, so keep asking
+                    msvcrt.locking(self.doc.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.doc.fileno(), fcntl.LOCK_UN)
+        else:
+            self.doc.seek(0)
+            msvcrt.locking(self.doc.fileno(), msvcrt.LK_UNLCK, 1)
+        self.doc.close()
+        self.doc = None
+        self.thread_lock.release()
+
+
+# Hands out transaction numbers from a counter file shared by every program using the
+# ledger, so two programs never give two transactions the same number.
+class TransactionAllocator:
+
+    def __init__(self, path=COUNTER, lock=None):
+        self.path = path
+        # its own lock file, so numbers can be taken while a save holds the ledger lock
+        self.lock = lock if lock is not None else FileLock(path + '.lock')
+
+    # the next free number, and never less than at_least; with count, the first of that
+    # many consecutive numbers, all taken at once
+    def allocate(self, at_least=1, count=1):
+        with self.lock:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as doc:
+                    number = int(doc.read())
+            except (FileNotFoundError, ValueError):
+                number = 1
+            number = max(number, at_least)
+            temp = self.path + '.tmp'
+            with open(temp, 'w', encoding='utf-8') as doc:
+                doc.write(str(number + count))
+            os.replace(temp, self.path)
+        return number
+
+
+# ---- Saving settings and ledger as one generation ---- #
+# resources/manifest.json names the files that make up the last complete save:
+#   {'generation': n, 'settings': sha256 of settings.json,
+#    'ledger': {'rows': n, ...what the store needs to find and check them}}
+# A save writes the new files beside the old ones (name + '.tmp') or appends past the
+# committed end, then replaces the manifest, then moves the new files into place. If it is
+# cut short before the manifest, the old generation is still whole; if after, the files
+# waiting under '.tmp' match the manifest and are moved into place on the next load.
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_checksum(path):
+    try:
+        with open(path, 'rb') as doc:
+            return checksum(doc.read())
+    except FileNotFoundError:
+        return checksum(b'')
+
+
+# settings.json as it is written
+def settings_data(settings):
+    return json.dumps(settings, indent=2).encode('utf-8')
+
+
+# writes data next to path as path + '.tmp', on disk before this returns
+def stage_file(path, data):
+    with open(path + '.tmp', 'wb') as doc:
+        doc.write(data)
+        doc.flush()
+        os.fsync(doc.fileno())
+
+
+# moves path + '.tmp' into place if it is the version with this checksum
+def roll_forward(path, expected):
+    temp = path + '.tmp'
+    try:
+        with open(temp, 'rb') as doc:
+            if checksum(doc.read()) != expected:
+                return
+        os.replace(temp, path)
+        logger.info("Finished saving %s.", path)
+    except FileNotFoundError:  # nothing waiting, or another program moved it first
+        pass
+
+
+# the last committed manifest, or None for files saved before there was one
+def read_manifest(path=MANIFEST):
+    try:
+        with open(path, 'r', encoding='utf-8') as doc:
+            return json.load(doc)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.error("Ignoring unreadable manifest %s.", path)
+        return None
+
+
+# the manifest's record of the ledger if it was last saved by this kind of store
+def committed_ledger(path, store):
+    committed = read_manifest(path)
+    if committed is None or committed['ledger'] is None or committed['ledger']['store'] != store:
+        return None
+    return committed['ledger']
+
+
+# checksum of the settings the last save committed, or of settings.json if none has said
+def committed_settings(path=MANIFEST, settings_path=SETTINGS):
+    manifest = read_manifest(path)
+    if manifest is None or manifest['settings'] is None:
+        return file_checksum(settings_path)
+    return manifest['settings']
+
+
+# Commits the ledger state from a store and, if given, new settings (a dict, or bytes from
+# settings_data) as the next generation. Whatever isn't given is carried over from the last
+# one. Hold the ledger lock.
+def commit_generation(ledger=None, settings=None, path=MANIFEST, settings_path=SETTINGS):
+    manifest = read_manifest(path) or {'generation': 0, 'settings': None, 'ledger': None}
+    if settings is not None:
+        data = settings if isinstance(settings, bytes) else settings_data(settings)
+        stage_file(settings_path, data)
+        manifest['settings'] = checksum(data)
+    elif manifest['settings'] is None:
+        manifest['settings'] = file_checksum(settings_path)
+    if ledger is not None:
+        manifest['ledger'] = ledger
+    manifest['generation'] += 1
+    stage_file(path, json.dumps(manifest).encode('utf-8'))
+    os.replace(path + '.tmp', path)
+    if settings is not None:
+        os.replace(settings_path + '.tmp', settings_path)
+    return manifest['generation']
+
+
+# Reads the settings of the last complete save, finishing it first if it was cut short.
+# Falls back to template for a new installation.
+def read_settings(path=SETTINGS, template=None, manifest=MANIFEST):
+    committed = read_manifest(manifest)
+    if committed is not None:
+        roll_forward(path, committed['settings'])
+    try:
+        with open(path, 'rb') as doc:
+            data = doc.read()
+    except FileNotFoundError:
+        if template is None:
+            raise
+        with open(template, 'r') as doc:
+            return json.load(doc)
+    if committed is not None and checksum(data) != committed['settings']:
+        logger.error("%s does not match its checksum from the last save.", path)
+    return json.loads(data.decode('utf-8'))
+
+
+# picks the store named by the 'storage' setting, and for the journal store the
+# snapshot named by 'snapshot_format', converting a JSON snapshot the first time
+def open_store(kind='journal', snapshot_format='json'):
+    if kind == 'sqlite':
+        return SQLiteStore()
+    # only the snapshot the last save committed is current, so when the setting has changed
+    # since, that one is converted to the format asked for before anything is read
+    current = committed_snapshot()
+    if snapshot_format == 'binary':
+        if current == SNAPSHOT or (current is None and not os.path.exists(BINARY_SNAPSHOT)
+                                   and os.path.exists(SNAPSHOT)):
+            from binformat import convert_snapshot
+            convert_snapshot(SNAPSHOT, BINARY_SNAPSHOT, MANIFEST)
+        return JournalStore(BINARY_SNAPSHOT, binary=True)
+    else:
+        if current == BINARY_SNAPSHOT:
+            from binformat import convert_snapshot
+            convert_snapshot(BINARY_SNAPSHOT, SNAPSHOT, MANIFEST, binary=False)
+        return JournalStore()
+
+
+# The snapshot file the last journal save committed: the binary one if the manifest says so
+# (or, for a manifest written before it said, if the checksum is that file's), otherwise the
+# JSON one. None if the manifest records no journal save.
+def committed_snapshot(manifest=MANIFEST, snapshot=SNAPSHOT, binary=BINARY_SNAPSHOT):
+    entry = committed_ledger(manifest, 'journal')
+    if entry is None:
+        return None
+    if 'format' in entry:
+        return binary if entry['format'] == 'binary' else snapshot
+    if os.path.exists(binary) and file_checksum(binary) == entry['snapshot']:
+        return binary
+    return snapshot
+
+
+# copies a matrices.txt ledger (and its journal, if any) into a new SQLite database
+def migrate_to_sqlite(snapshot=SNAPSHOT, database=DATABASE, journal=JOURNAL):
+    ledger = JournalStore(snapshot, journal).load()
+    target = SQLiteStore(database)
+    target.load()
+    if target.saved > 0:
+        raise FileExistsError('{} already holds {} ledger rows.'.format(database, target.saved))
+    target.append(ledger)
+    target.close()
+    logger.info("Copied %s rows from %s to %s.", len(ledger), snapshot, database)
+    return len(ledger)
+
+
+# 'DD/MM/YYYY' -> proleptic Gregorian ordinal, or None if the date can't be read
+def date_ordinal(date):
+    try:
+        return datetime.date(int(date[6:]), int(date[3:5]), int(date[:2])).toordinal()
+    except (ValueError, TypeError):
+        return None
+
+
+# amounts loaded from JSON may be floats; repr() keeps the digits that were saved
+def to_text(value):
+    if value is None:
+        return None
+    elif isinstance(value, float):
+        return repr(value)
+    else:
+        return str(value)
+
+
+def to_decimal(text):
+    if text is None:
+        return None
+    else:
+        return decimal.Decimal(text)
+
+
+# Written after every save: everything the window needs to open without reading
+# the whole ledger. {'rows': n, 'transaction': next#, 'balances': {number: debits - credits},
+# 'recent': [last RECENT_ROWS ledger rows]}
+# Only the first 'rows' rows of the ledger are counted if given.
+def write_summary(ledger, transaction, balances, path=SUMMARY, rows=None):
+    if rows is None:
+        rows = len(ledger)
+    summary = {'rows': rows,
+               'transaction': transaction,
+               'balances': balances,
+               'recent': ledger[max(rows - RECENT_ROWS, 0):rows]}
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as doc:
+        json.dump(summary, doc, ensure_ascii=False, use_decimal=True)
+    os.replace(temp, path)
+
+
+# returns the saved summary, or None if there isn't a usable one
+def read_summary(path=SUMMARY):
+    try:
+        with open(path, 'r', encoding='utf-8') as doc:
+            return json.load(doc, use_decimal=True)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning("Ignoring unreadable ledger summary %s.", path)
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy a CFAP ledger into a SQLite database.')
+    parser.add_argument('snapshot', nargs='?', default=SNAPSHOT, help='ledger file (default: %(default)s)')
+    parser.add_argument('database', nargs='?', default=DATABASE, help='new database (default: %(default)s)')
+    parser.add_argument('--journal', default=JOURNAL, help='journal to replay (default: %(default)s)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    migrate_to_sqlite(args.snapshot, args.database, args.journal)